@@ -1,4 +1,5 @@
 import fiona
+import pyogrio
 import pandas as pd
 import os
 import shapely.geometry as geo
@@ -10,11 +11,22 @@ import numpy as np
 
 """
 This stage loads the raw data from the French building registry (BD-TOPO).
+
+The archives are processed in parallel. By default, the buildings are read
+feature by feature using fiona. Alternatively, they can be read in bulk using
+pyogrio, in which case only the relevant columns are read and buildings
+without housing are filtered out while reading.
+
+Optionally, the buildings that have been read from an archive are cached in a
+separate directory, identified by the name, size and modification time of the
+archive, so that they don't need to be extracted and read again.
 """
- 
+
 def configure(context):
     context.config("data_path")
     context.config("bdtopo_path", "bdtopo_idf")
+    context.config("bdtopo_reader", "fiona")
+    context.config("bdtopo_cache_path", None)
 
     context.stage("data.spatial.departments")
 
@@ -28,74 +40,141 @@ def get_department_string(department_id):
     else:
         raise RuntimeError("Department identifier should have at least two characters")
 
+def read_fiona(geometry_path):
+    data = { "cleabs": [], "nombre_de_logements": [], "geometry": [] }
+
+    with fiona.open(geometry_path, layer = "batiment") as package:
+        for item in package:
+            data["cleabs"].append(item["properties"]["cleabs"])
+            data["nombre_de_logements"].append(item["properties"]["nombre_de_logements"])
+            data["geometry"].append(geo.shape(item["geometry"]))
+
+    df_buildings = pd.DataFrame(data)
+    df_buildings = gpd.GeoDataFrame(df_buildings, crs = "EPSG:2154")
+
+    return df_buildings, len(df_buildings)
+
+def read_pyogrio(geometry_path):
+    initial_count = pyogrio.read_info(geometry_path, layer = "batiment")["features"]
+
+    df_buildings = pyogrio.read_dataframe(geometry_path, layer = "batiment",
+        columns = ["cleabs", "nombre_de_logements"], where = "nombre_de_logements > 0",
+        use_arrow = True)
+
+    return df_buildings, initial_count
+
+READERS = dict(fiona = read_fiona, pyogrio = read_pyogrio)
+
+def get_cache_path(context, source_path):
+    if context.config("bdtopo_cache_path") is None:
+        return None
+
+    status = os.stat(source_path)
+
+    return "{}/{}_{}_{}.p".format(context.config("bdtopo_cache_path"),
+        os.path.basename(source_path)[:-3], status.st_size, status.st_mtime_ns)
+
+def read_buildings(context, index, source_path):
+    geometry_path = None
+    extraction_path = "{}/{}".format(context.data("path"), index)
+
+    with py7zr.SevenZipFile(source_path) as archive:
+        # Find the path inside the archive
+        internal_path = [path for path in archive.getnames() if path.endswith(".gpkg")]
+
+        if len(internal_path) == 1:
+            archive.extract(extraction_path, internal_path[0])
+            geometry_path = "{}/{}".format(extraction_path, internal_path[0])
+
+    if geometry_path is None:
+        return None
+
+    df_buildings, initial_count = READERS[context.config("bdtopo_reader")](geometry_path)
+    os.remove(geometry_path)
+
+    df_buildings["building_id"] = df_buildings["cleabs"].apply(lambda x: int(x[8:]))
+    df_buildings["housing"] = df_buildings["nombre_de_logements"].fillna(0).astype(int)
+    df_buildings = df_buildings[df_buildings["housing"] > 0]
+
+    return df_buildings[["building_id", "housing", "geometry"]], initial_count
+
+def process_archive(context, arguments):
+    index, source_path = arguments
+
+    cache_path = get_cache_path(context, source_path)
+
+    if not cache_path is None and os.path.exists(cache_path):
+        result = pd.read_pickle(cache_path)
+    else:
+        result = read_buildings(context, index, source_path)
+
+        if not cache_path is None and not result is None:
+            # write to a temporary file first, so that an interrupted run does not leave a truncated cache
+            temporary_path = "{}.{}".format(cache_path, os.getpid())
+            pd.to_pickle(result, temporary_path)
+            os.replace(temporary_path, cache_path)
+
+    context.progress.update()
+
+    if result is None:
+        return None
+
+    df_buildings, initial_count = result
+    housing_count = len(df_buildings)
+
+    df_buildings = df_buildings.copy()
+    df_buildings["centroid"] = df_buildings["geometry"].centroid
+    df_buildings = df_buildings.set_geometry("centroid")
+
+    df_buildings = gpd.sjoin(df_buildings, context.data("departments"), predicate = "within")
+
+    df_buildings["department_id"] = df_buildings["departement_id"]
+    df_buildings = df_buildings.set_geometry("geometry")
+
+    return df_buildings[["building_id", "housing", "department_id", "geometry"]], initial_count, housing_count
+
 def execute(context):
     df_departments = context.stage("data.spatial.departments")
     print("Expecting data for {} departments".format(len(df_departments)))
-    
+
     source_paths = find_bdtopo("{}/{}".format(context.config("data_path"), context.config("bdtopo_path")))
 
+    if not context.config("bdtopo_cache_path") is None:
+        os.makedirs(context.config("bdtopo_cache_path"), exist_ok = True)
+
     df_bdtopo = []
     known_ids = set()
 
-    for source_path in source_paths:
-        print("Loading {}".format(source_path.split("/")[-1]))
-        geometry_path = None
-
-        with py7zr.SevenZipFile(source_path) as archive:
-            # Find the path inside the archive
-            internal_path = [path for path in archive.getnames() if path.endswith(".gpkg")]
-            
-            if len(internal_path) != 1:
-                print("  Skipping: No unambiguous geometry source found!")
-
-            else:
-                print("  Extracting ...")
-                archive.extract(context.path(), internal_path[0])
-                geometry_path = "{}/{}".format(context.path(), internal_path[0])
-
-        if geometry_path is not None:
-            with context.progress(label = "  Reading ...") as progress:
-                data = { "cleabs": [], "nombre_de_logements": [], "geometry": [] }
-                with fiona.open(geometry_path, layer = "batiment") as package:
-                    for item in package:
-                        data["cleabs"].append(item["properties"]["cleabs"])
-                        data["nombre_de_logements"].append(item["properties"]["nombre_de_logements"])
-                        data["geometry"].append(geo.shape(item["geometry"]))
-                        progress.update()
-
-                df_buildings = pd.DataFrame(data)
-                df_buildings = gpd.GeoDataFrame(df_buildings, crs = "EPSG:2154")
-            
-            df_buildings["building_id"] = df_buildings["cleabs"].apply(lambda x: int(x[8:]))
-            df_buildings["housing"] = df_buildings["nombre_de_logements"].fillna(0).astype(int)
-
-            df_buildings["centroid"] = df_buildings["geometry"].centroid
-            df_buildings = df_buildings.set_geometry("centroid")
-
-            print("  Filtering ...")
-
-            initial_count = len(df_buildings)
-            df_buildings = df_buildings[df_buildings["housing"] > 0]
-            final_count = len(df_buildings)
-            print("    {}/{} filtered by dwellings".format(initial_count - final_count, initial_count))
-
-            initial_count = len(df_buildings)
-            df_buildings = df_buildings[~df_buildings["building_id"].isin(known_ids)]
-            final_count = len(df_buildings)
-            print("    {}/{} filtered duplicates".format(initial_count - final_count, initial_count))
-
-            initial_count = len(df_buildings)
-            df_buildings = gpd.sjoin(df_buildings, df_departments, predicate = "within")
-            final_count = len(df_buildings)
-            print("    {}/{} filtered spatially".format(initial_count - final_count, initial_count))
-
-            df_buildings["department_id"] = df_buildings["departement_id"]
-            df_buildings = df_buildings.set_geometry("geometry")
-
-            df_bdtopo.append(df_buildings[["building_id", "housing", "department_id", "geometry"]])
-            known_ids |= set(df_buildings["building_id"].unique())
-
-            os.remove(geometry_path)
+    parallel_data = dict(
+        path = context.path(),
+        departments = df_departments[["departement_id", "geometry"]]
+    )
+
+    with context.progress(label = "Reading BD TOPO ...", total = len(source_paths)):
+        with context.parallel(parallel_data) as parallel:
+            results = parallel.imap(process_archive, enumerate(source_paths))
+
+            # Archives are handled in order, as the first occurence of a building is kept
+            for source_path, result in zip(source_paths, results):
+                print("Loading {}".format(source_path.split("/")[-1]))
+
+                if result is None:
+                    print("  Skipping: No unambiguous geometry source found!")
+                    continue
+
+                df_buildings, initial_count, housing_count = result
+
+                print("  Filtering ...")
+                print("    {}/{} filtered by dwellings".format(initial_count - housing_count, initial_count))
+                print("    {}/{} filtered spatially".format(housing_count - len(df_buildings), housing_count))
+
+                initial_count = len(df_buildings)
+                df_buildings = df_buildings[~df_buildings["building_id"].isin(known_ids)]
+                final_count = len(df_buildings)
+                print("    {}/{} filtered duplicates".format(initial_count - final_count, initial_count))
+
+                df_bdtopo.append(df_buildings)
+                known_ids |= set(df_buildings["building_id"].unique())
 
     df_bdtopo = pd.concat(df_bdtopo)
 
@@ -109,9 +188,12 @@ def find_bdtopo(path):
 
     if len(candidates) == 0:
         raise RuntimeError("BD TOPO data is not available in {}".format(path))
-    
+
     return candidates
 
 def validate(context):
+    if not context.config("bdtopo_reader") in READERS:
+        raise RuntimeError("Unknown BD TOPO reader: {}".format(context.config("bdtopo_reader")))
+
     paths = find_bdtopo("{}/{}".format(context.config("data_path"), context.config("bdtopo_path")))
     return sum([os.path.getsize(path) for path in paths])
@@ -1,6 +1,7 @@
 import numpy as np
 import shapely.geometry as geo
 import data.spatial.utils as spatial_utils
+import data.shared as shared
 import geopandas as gpd
 
 """
@@ -17,6 +18,7 @@ def configure(context):
     context.stage("data.spatial.municipalities")
 
     context.config("bpe_random_seed", 0)
+    shared.configure(context)
 
 ACTIVITY_TYPE_MAP = [
     ("A", "other"),         # Police, post office, etc ...
@@ -30,8 +32,8 @@ ACTIVITY_TYPE_MAP = [
 ]
 
 def find_outside(context, commune_id):
-    df_municipalities = context.data("df_municipalities")
-    df = context.data("df")
+    df_municipalities = shared.data(context, "df_municipalities")
+    df = shared.data(context, "df")
 
     df = df[df["commune_id"] == commune_id]
     zone = df_municipalities[df_municipalities["commune_id"] == commune_id]["geometry"].values[0]
@@ -123,9 +125,10 @@ def execute(context):
     outside_indices = []
 
     with context.progress(label = "Finding outside observations ...", total = len(df["commune_id"].unique())):
-        with context.parallel(dict(df = df, df_municipalities = df_municipalities)) as parallel:
-            for partial in parallel.imap(find_outside, df["commune_id"].unique()):
-                outside_indices += partial
+        with shared.publish(context, dict(df = df, df_municipalities = df_municipalities)) as data:
+            with context.parallel(data) as parallel:
+                for partial in parallel.imap(find_outside, df["commune_id"].unique()):
+                    outside_indices += partial
 
     if len(outside_indices) > 0:
         df.loc[outside_indices, "x"] = np.nan
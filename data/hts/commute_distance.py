@@ -1,5 +1,6 @@
 import pandas as pd
 import numpy as np
+import data.sampling as sampling
 
 def configure(context):
     context.config("random_seed")
@@ -34,13 +35,8 @@ def get_commuting_distance(df_persons, df_trips, activity_type, random):
     values = values[sorter]
     weights = weights[sorter]
 
-    cdf = np.cumsum(weights)
-    cdf /= cdf[-1]
-
-    indices = [
-        np.searchsorted(cdf, r)
-        for r in random.random_sample(size = np.count_nonzero(f_missing))
-    ]
+    cdf = sampling.build_cdf(weights)
+    indices = sampling.sample_indices(random.random_sample(size = np.count_nonzero(f_missing)), cdf)
 
     df_persons.loc[f_missing, "commute_distance"] = values[indices]
 
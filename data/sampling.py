@@ -0,0 +1,134 @@
+import numpy as np
+import numba
+
+"""
+Shared sampling kernels for the pipeline. All functions are deterministic given
+the uniform random numbers that are passed in, so the stages keep full control
+over their random streams.
+
+Two strategies are provided:
+- Inverse CDF sampling with a binary search, O(log n) per draw.
+- Walker alias tables, O(n) to set up and O(1) per draw, which pays off when
+  many draws are taken from the same distribution.
+"""
+
+@numba.jit(nopython = True, cache = True)
+def build_cdf(weights):
+    """
+    Builds a normalized cumulative distribution from non-negative weights.
+    """
+    cdf = np.cumsum(weights.astype(np.float64))
+    cdf /= cdf[-1]
+    return cdf
+
+@numba.jit(nopython = True, cache = True)
+def sample_indices(uniform, cdf):
+    """
+    Inverse CDF sampling. For every uniform value, the number of CDF entries
+    that are strictly smaller is returned, which is the index of the sampled
+    element. The CDF must be non-decreasing.
+    """
+    return np.searchsorted(cdf, uniform, side = "left")
+
+@numba.jit(nopython = True, cache = True)
+def build_alias_table(weights):
+    """
+    Builds a Walker alias table (using Vose's construction) for the given
+    non-negative weights. Returns the acceptance probabilities and the
+    alias indices.
+    """
+    count = len(weights)
+
+    probabilities = weights * count / np.sum(weights)
+    aliases = np.arange(count)
+
+    small = np.empty(count, dtype = np.int64)
+    large = np.empty(count, dtype = np.int64)
+    small_count, large_count = 0, 0
+
+    for index in range(count):
+        if probabilities[index] < 1.0:
+            small[small_count] = index
+            small_count += 1
+        else:
+            large[large_count] = index
+            large_count += 1
+
+    while small_count > 0 and large_count > 0:
+        small_count -= 1
+        large_count -= 1
+
+        small_index = small[small_count]
+        large_index = large[large_count]
+
+        aliases[small_index] = large_index
+        probabilities[large_index] = probabilities[large_index] + probabilities[small_index] - 1.0
+
+        if probabilities[large_index] < 1.0:
+            small[small_count] = large_index
+            small_count += 1
+        else:
+            large[large_count] = large_index
+            large_count += 1
+
+    # Remaining entries only differ from one by numerical errors
+    for index in range(large_count):
+        probabilities[large[index]] = 1.0
+
+    for index in range(small_count):
+        probabilities[small[index]] = 1.0
+
+    return probabilities, aliases
+
+@numba.jit(nopython = True, cache = True)
+def sample_alias(uniform, probabilities, aliases):
+    """
+    Samples from a Walker alias table using one uniform value per draw: the
+    integer part of the scaled value selects the column, the fractional part
+    decides between the column and its alias.
+    """
+    count = len(probabilities)
+    indices = np.empty(len(uniform), dtype = np.int64)
+
+    for k in range(len(uniform)):
+        scaled = uniform[k] * count
+        column = min(int(scaled), count - 1)
+
+        if scaled - column < probabilities[column]:
+            indices[k] = column
+        else:
+            indices[k] = aliases[column]
+
+    return indices
+
+@numba.jit(nopython = True, cache = True)
+def sample_segmented(uniform, cdf, offsets, segments):
+    """
+    Inverse CDF sampling from many distributions at once. The CDFs are stored
+    one after another in a flat array, where segment k spans the range from
+    offsets[k] to offsets[k + 1]. For every uniform value, the segment to
+    sample from is given in segments. The global index of the sampled element
+    in the flat array is returned.
+    """
+    indices = np.empty(len(uniform), dtype = np.int64)
+
+    for k in range(len(uniform)):
+        start, end = offsets[segments[k]], offsets[segments[k] + 1]
+        indices[k] = start + np.searchsorted(cdf[start:end], uniform[k], side = "left")
+
+    return indices
+
+@numba.jit(nopython = True, cache = True)
+def build_segmented_cdf(weights, offsets):
+    """
+    Builds the normalized cumulative distributions of many segments of weights
+    at once, stored in the same layout as expected by sample_segmented. Every
+    segment gives exactly the same values as build_cdf would.
+    """
+    cdf = np.empty(len(weights), dtype = np.float64)
+
+    for k in range(len(offsets) - 1):
+        start, end = offsets[k], offsets[k + 1]
+        cdf[start:end] = build_cdf(weights[start:end])
+
+    return cdf
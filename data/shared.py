@@ -0,0 +1,240 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import contextlib
+import tempfile
+import shutil
+
+"""
+Helpers to exchange large data sets with the workers of a parallel context
+through memory-mapped files instead of pickled copies.
+
+A stage publishes its data once when opening the parallel context and the
+workers attach to the published files in read-only mode. Since all workers map
+the same files, the operating system keeps only one copy of the data in
+memory, independent of the number of processes.
+
+Numeric, boolean and categorical columns, numeric indices and point geometries
+are shared, as well as arrays inside of dictionaries and tuples. Everything else (object columns, other geometry types, scalars) is
+passed to the workers as before.
+
+Point geometries are shared as their coordinates. Creating the points would
+copy them into every process, so the workers obtain a frame in which every
+point column is replaced by its coordinates. Workers that need the points call
+shared.points on the rows that they actually use.
+
+Sharing is activated with the 'shared_data' configuration option. Stages that
+make use of it need to call configure(context) in their own configuration.
+"""
+
+def configure(context):
+    context.config("shared_data", False)
+
+class SharedArray:
+    def __init__(self, path):
+        self.path = path
+
+    def attach(self):
+        return np.asarray(np.load(self.path, mmap_mode = "r"))
+
+class SharedFrame:
+    def __init__(self, columns, index, geometry, crs):
+        self.columns = columns
+        self.index = index
+        self.geometry = geometry
+        self.crs = crs
+
+    def attach(self):
+        columns = {}
+
+        for name, (kind, payload) in self.columns:
+            if kind == "array":
+                columns[name] = payload.attach()
+
+            elif kind == "categorical":
+                codes, categories, ordered = payload
+                columns[name] = pd.Categorical.from_codes(codes.attach(), categories = categories, ordered = ordered)
+
+            elif kind == "points":
+                x, y, crs = payload
+                columns["%s:x" % name] = x.attach()
+                columns["%s:y" % name] = y.attach()
+
+            else: # value
+                columns[name] = payload
+
+        kind, payload = self.index
+
+        if kind == "range":
+            index = pd.RangeIndex(*payload)
+        elif kind == "array":
+            index = payload.attach()
+        else: # value
+            index = payload
+
+        df = pd.DataFrame(columns, index = index, copy = False)
+
+        if not self.geometry is None and self.geometry in df:
+            df = gpd.GeoDataFrame(df, geometry = self.geometry, crs = self.crs)
+
+        df.attrs["shared_points"] = {
+            name: payload[2] for name, (kind, payload) in self.columns if kind == "points"
+        }
+
+        df.attrs["shared_geometry"] = self.geometry
+        return df
+
+def _write_array(path, values):
+    np.save(path, values, allow_pickle = False)
+    return SharedArray(path)
+
+def _is_shareable(values):
+    return isinstance(values, np.ndarray) and values.dtype.kind in "biufcmMS"
+
+def _publish_frame(path, df):
+    columns = []
+
+    for index, name in enumerate(df.columns):
+        column_path = "%s_%d" % (path, index)
+        values = df[name]
+
+        if isinstance(values.dtype, gpd.array.GeometryDtype):
+            values = gpd.GeoSeries(values)
+
+            if len(values) > 0 and not values.isna().any() and (values.geom_type == "Point").all():
+                columns.append((name, ("points", (
+                    _write_array(column_path + "_x.npy", values.x.values),
+                    _write_array(column_path + "_y.npy", values.y.values),
+                    values.crs
+                ))))
+            else:
+                columns.append((name, ("value", values.values)))
+
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            columns.append((name, ("categorical", (
+                _write_array(column_path + ".npy", values.cat.codes.values),
+                values.cat.categories, values.cat.ordered
+            ))))
+
+        elif _is_shareable(values.values):
+            columns.append((name, ("array", _write_array(column_path + ".npy", values.values))))
+
+        else:
+            columns.append((name, ("value", values.values)))
+
+    if isinstance(df.index, pd.RangeIndex):
+        index = ("range", (df.index.start, df.index.stop, df.index.step))
+    elif _is_shareable(df.index.values):
+        index = ("array", _write_array(path + "_index.npy", df.index.values))
+    else:
+        index = ("value", df.index)
+
+    geometry, crs = None, None
+
+    if isinstance(df, gpd.GeoDataFrame) and df._geometry_column_name in df:
+        geometry, crs = df._geometry_column_name, df.crs
+
+    return SharedFrame(columns, index, geometry, crs)
+
+def _publish(path, value):
+    if isinstance(value, dict):
+        return {
+            key: _publish("%s_%d" % (path, index), item)
+            for index, (key, item) in enumerate(value.items())
+        }
+
+    elif isinstance(value, tuple):
+        return tuple(_publish("%s_%d" % (path, index), item) for index, item in enumerate(value))
+
+    elif isinstance(value, pd.DataFrame):
+        return _publish_frame(path, value)
+
+    elif _is_shareable(value):
+        return _write_array(path + ".npy", value)
+
+    else:
+        return value
+
+def points(df, names = ("geometry",)):
+    """
+    Creates the point columns of a frame that has been obtained through
+    shared.data from their shared coordinates. This should be done after
+    selecting the relevant rows, so that only these points are created in the
+    worker. Columns that are already available are left untouched, so frames
+    that have not been shared are returned as they are.
+    """
+    shared_points = df.attrs.get("shared_points", {})
+    geometry = df.attrs.get("shared_geometry")
+
+    missing = [name for name in names if not name in df]
+
+    if len(missing) == 0:
+        return df
+
+    df = df.copy()
+
+    for name in missing:
+        if not name in shared_points:
+            raise RuntimeError("Column is neither available nor shared as points: %s" % name)
+
+        x, y = "%s:x" % name, "%s:y" % name
+        location = df.columns.get_loc(x)
+
+        values = gpd.points_from_xy(df[x].values, df[y].values, crs = shared_points[name])
+        df = df.drop(columns = [x, y])
+        df.insert(location, name, values)
+
+    if not geometry is None and geometry in df and not isinstance(df, gpd.GeoDataFrame):
+        df = gpd.GeoDataFrame(df, geometry = geometry, crs = shared_points.get(geometry))
+
+    return df
+
+_attached = {}
+
+@contextlib.contextmanager
+def publish(context, data):
+    """
+    Publishes the data for a parallel context. Yields the (possibly
+    transformed) data that should be passed to context.parallel. Inside of
+    the workers, the data should be obtained through shared.data.
+    """
+    if not context.config("shared_data"):
+        yield data
+        return
+
+    path = tempfile.mkdtemp(prefix = "shared_", dir = context.path())
+
+    try:
+        yield {
+            name: _publish("%s/%d" % (path, index), value)
+            for index, (name, value) in enumerate(data.items())
+        }
+
+    finally:
+        _attached.clear()
+        shutil.rmtree(path, ignore_errors = True)
+
+def _attach(value):
+    if isinstance(value, dict):
+        return { key: _attach(item) for key, item in value.items() }
+
+    elif isinstance(value, tuple):
+        return tuple(_attach(item) for item in value)
+
+    elif isinstance(value, (SharedArray, SharedFrame)):
+        return value.attach()
+
+    else:
+        return value
+
+def data(context, name):
+    """
+    Obtains data from a parallel context. Published data is attached once per
+    process and then reused for all subsequent tasks.
+    """
+    value = context.data(name)
+
+    if not id(value) in _attached:
+        _attached[id(value)] = (value, _attach(value))
+
+    return _attached[id(value)][1]
@@ -2,6 +2,7 @@ import shapely.geometry as geo
 import numpy as np
 import geopandas as gpd
 import pandas as pd
+import data.shared as shared
 
 def to_gpd(context, df, x = "x", y = "y", crs = "EPSG:2154", column = "geometry"):
     df[column] = [
@@ -36,8 +37,8 @@ def sample_from_shape(shape, count, random, sample_size = None):
 def _sample_from_zones(context, args):
     attribute_value, random_seed = args
 
-    df_zones = context.data("df_zones")
-    df = context.data("df")
+    df_zones = shared.data(context, "df_zones")
+    df = shared.data(context, "df")
     attribute = context.data("attribute")
 
     random = np.random.RandomState(random_seed)
@@ -57,8 +58,9 @@ def sample_from_zones(context, df_zones, df, attribute, random, label = "Samplin
 
     df_result = []
 
-    with context.parallel(dict(df_zones = df_zones, df = df, attribute = attribute)) as parallel:
-        for df_partial in context.progress(parallel.imap(_sample_from_zones, zip(unique_values, random_seeds)), label = label, total = len(unique_values)):
-            df_result.append(df_partial)
+    with shared.publish(context, dict(df_zones = df_zones, df = df, attribute = attribute)) as data:
+        with context.parallel(data) as parallel:
+            for df_partial in context.progress(parallel.imap(_sample_from_zones, zip(unique_values, random_seeds)), label = label, total = len(unique_values)):
+                df_result.append(df_partial)
 
     return pd.concat(df_result)
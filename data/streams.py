@@ -0,0 +1,153 @@
+import numpy as np
+import numba
+import hashlib
+
+"""
+Counter-based random streams for the stochastic stages of the pipeline.
+
+By default, stages derive the seeds of their workers from a random state that
+is advanced once per chunk of work, so the outcome depends on how the work is
+split, for instance on the number of processes. With the 'random_streams'
+option set to 'counter', stages draw their random numbers from a Philox stream
+instead, which is keyed by the random seed and the name of the stage and
+positioned by the identifier of the entity (household, person, commune, ...)
+that is being sampled. The random numbers of an entity then do not depend on
+the number of processes, the order in which the entities are processed or on
+which machine they are processed.
+
+Stages that make use of it need to call configure(context) in their own
+configuration.
+
+When the population is created in partitions of home departements (see
+synthesis.partitioned_output), the stages after synthesis.population.sampled
+run once per partition. They obtain their seed through get_random_seed, which
+derives a separate seed for every partition, so that the partitions do not
+repeat the same random sequences. Such stages need to call
+configure_seed(context) in their configuration.
+"""
+
+STREAM_MODES = ("seeds", "counter")
+
+def configure(context):
+    context.config("random_streams", "seeds")
+
+    if not context.config("random_streams") in STREAM_MODES:
+        raise RuntimeError("Unknown random streams: %s" % context.config("random_streams"))
+
+def is_counter(context):
+    return context.config("random_streams") == "counter"
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], "little")
+
+def configure_seed(context):
+    context.config("random_seed")
+    context.config("home_departements", None)
+
+def get_random_seed(context):
+    """
+    Returns the random seed of a stage that depends on the persons. Without
+    partitions, this is the configured random seed. Otherwise, the seed is
+    derived from the random seed and the departements of the partition.
+    """
+    random_seed = context.config("random_seed")
+    departements = context.config("home_departements")
+
+    if departements is None:
+        return random_seed
+
+    departements = sorted(set(str(departement_id) for departement_id in departements))
+    return _hash((int(random_seed), tuple(departements))) % 2**32
+
+def get_identifier(identifier):
+    """
+    Converts an entity identifier into the 64 bit position of its stream.
+    Integer identifiers are used as they are, others (such as commune or IRIS
+    codes) are hashed.
+    """
+    if isinstance(identifier, (int, np.integer)) and not isinstance(identifier, bool):
+        return int(identifier) % 2**64
+
+    return _hash(identifier)
+
+def get_key(random_seed, stage):
+    return np.array([int(random_seed) % 2**64, _hash(stage)], dtype = np.uint64)
+
+def create_bit_generator(random_seed, stage, identifier):
+    """
+    Creates the Philox bit generator of one entity. It can be passed to
+    np.random.RandomState in place of a seed.
+    """
+    return np.random.Philox(
+        key = get_key(random_seed, stage),
+        counter = np.array([0, 0, 0, get_identifier(identifier)], dtype = np.uint64))
+
+def get_state(random_seed, stage, identifier):
+    """
+    Returns the state of the stream of one entity, which can be set on an
+    existing random state that has been created from a Philox bit generator.
+    """
+    state = create_bit_generator(random_seed, stage, identifier).state
+    state.update(has_gauss = 0, gauss = 0.0)
+    return state
+
+_MULTIPLIERS = (np.uint64(0xD2E7470EE14C6C93), np.uint64(0xCA5A826395121157))
+_WEYL = (np.uint64(0x9E3779B97F4A7C15), np.uint64(0xBB67AE8584CAA73B))
+
+@numba.jit(nopython = True, cache = True)
+def _multiply(a, b):
+    # Returns the high and low 64 bits of the 128 bit product
+    mask = np.uint64(0xFFFFFFFF)
+    shift = np.uint64(32)
+
+    a_low, a_high = a & mask, a >> shift
+    b_low, b_high = b & mask, b >> shift
+
+    low_low = a_low * b_low
+    high_low = a_high * b_low
+    low_high = a_low * b_high
+    high_high = a_high * b_high
+
+    cross = (low_low >> shift) + (high_low & mask) + low_high
+    return high_high + (high_low >> shift) + (cross >> shift), a * b
+
+@numba.jit(nopython = True, cache = True)
+def _philox_uniform(key, positions, multipliers, weyl):
+    """
+    Returns the first uniform value of the stream at every position by
+    computing one block of Philox4x64-10. The values are the same as the first
+    value drawn by np.random.RandomState(create_bit_generator(...)).
+    """
+    uniform = np.empty(len(positions), dtype = np.float64)
+
+    for k in range(len(positions)):
+        counter0, counter1, counter2, counter3 = np.uint64(1), np.uint64(0), np.uint64(0), positions[k]
+        key0, key1 = key[0], key[1]
+
+        for round in range(10):
+            if round > 0:
+                key0 += weyl[0]
+                key1 += weyl[1]
+
+            high0, low0 = _multiply(multipliers[0], counter0)
+            high1, low1 = _multiply(multipliers[1], counter2)
+
+            counter0, counter1, counter2, counter3 = high1 ^ counter1 ^ key0, low1, high0 ^ counter3 ^ key1, low0
+
+        uniform[k] = (counter0 >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+
+    return uniform
+
+def sample_uniform(random_seed, stage, identifiers):
+    """
+    Draws one uniform value per entity at once.
+    """
+    identifiers = np.asarray(identifiers)
+
+    if identifiers.dtype.kind in "iu":
+        positions = identifiers.astype(np.uint64)
+    else:
+        positions = np.array([get_identifier(identifier) for identifier in identifiers], dtype = np.uint64)
+
+    return _philox_uniform(get_key(random_seed, stage), positions,
+        np.array(_MULTIPLIERS, dtype = np.uint64), np.array(_WEYL, dtype = np.uint64))
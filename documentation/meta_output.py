@@ -25,6 +25,10 @@ def get_commit():
     except sp.CalledProcessError:
         return "unknown"
 
+def write_information(path, information):
+    with open(path, "w+") as f:
+        json.dump(information, f, indent = 4)
+
 def execute(context):
     # Write meta information
     information = dict(
@@ -36,8 +40,8 @@ def execute(context):
         commit = get_commit()
     )
 
-    with open("%s/%smeta.json" % (context.config("output_path"), context.config("output_prefix")), "w+") as f:
-        json.dump(information, f, indent = 4)
+    write_information("%s/%smeta.json" % (context.config("output_path"), context.config("output_prefix")), information)
+    return information
 
 def validate(context):
     return get_version()
@@ -2,6 +2,7 @@ import pandas as pd
 import numpy as np
 import geopandas as gpd
 import numpy as np
+import shapely
 
 """
 This stage assigns adresses from BAN to residential buildings from BD TOPO.
@@ -16,17 +17,80 @@ adresses. For instance, the assigned addresses of a building with 10 housing uni
 and two addresses will have a weight of 5.
 
 If no adresses matches a building, its centroid is taken as the unique address.
+
+Instead of buffering the buildings, addresses can also be matched by querying
+all buildings within the given distance of an address (dwithin mode). The
+addresses are processed in spatial tiles in parallel, which avoids creating
+the buffer polygons and their spatial index for all buildings at once.
 """
 
 def configure(context):
     context.stage("data.bdtopo.raw")
     
     context.config("home_address_buffer", 5.0)
+    context.config("home_address_matching", "buffer")
+    context.config("home_address_tile_size", 10000.0)
 
     context.config("home_location_weight", "housing")
     if context.config("home_location_source", "addresses") == "addresses":
         context.stage("data.ban.raw")
 
+def match_tile(context, arguments):
+    address_indices, coordinates, building_indices, buildings, distance = arguments
+
+    tree = shapely.STRtree(buildings)
+    pairs = tree.query(shapely.points(coordinates), predicate = "dwithin", distance = distance)
+
+    context.progress.update()
+    return address_indices[pairs[0]], building_indices[pairs[1]]
+
+def match_within_distance(context, df_addresses, df_buildings):
+    distance = context.config("home_address_buffer")
+    tile_size = context.config("home_address_tile_size")
+
+    # Partition addresses into square tiles
+    coordinates = np.vstack([df_addresses["geometry"].x.values, df_addresses["geometry"].y.values]).T
+    tiles = np.floor(coordinates / tile_size).astype(np.int64)
+    tile_indices = pd.MultiIndex.from_arrays([tiles[:, 0], tiles[:, 1]]).factorize()[0] if len(tiles) > 0 else np.zeros((0,), dtype = int)
+
+    sorter = np.argsort(tile_indices, kind = "stable")
+    offsets = np.hstack([[0], np.cumsum(np.bincount(tile_indices))]) if len(tiles) > 0 else [0]
+
+    # Find the buildings that are relevant for each tile
+    building_geometries = df_buildings["geometry"].values
+    building_tree = shapely.STRtree(building_geometries)
+
+    def generate_tiles():
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            address_indices = sorter[start:end]
+            tile_coordinates = coordinates[address_indices]
+
+            minimum = np.min(tile_coordinates, axis = 0) - distance
+            maximum = np.max(tile_coordinates, axis = 0) + distance
+
+            building_indices = building_tree.query(shapely.box(minimum[0], minimum[1], maximum[0], maximum[1]))
+            yield address_indices, tile_coordinates, building_indices, building_geometries[building_indices], distance
+
+    address_indices, building_indices = [np.zeros((0,), dtype = int)], [np.zeros((0,), dtype = int)]
+
+    with context.progress(label = "Matching addresses to buildings ...", total = len(offsets) - 1):
+        with context.parallel() as parallel:
+            for tile_address_indices, tile_building_indices in parallel.imap_unordered(match_tile, generate_tiles()):
+                address_indices.append(tile_address_indices)
+                building_indices.append(tile_building_indices)
+
+    address_indices = np.hstack(address_indices)
+    building_indices = np.hstack(building_indices)
+
+    # Make the order independent of tiles and processes
+    sorter = np.lexsort((building_indices, address_indices))
+    address_indices, building_indices = address_indices[sorter], building_indices[sorter]
+
+    return gpd.GeoDataFrame(dict(
+        building_id = df_buildings["building_id"].values[building_indices],
+        housing = df_buildings["housing"].values[building_indices],
+    ), geometry = df_addresses["geometry"].values[address_indices], crs = df_addresses.crs)
+
 def execute(context):
     # Load buildings
     df_buildings = context.stage("data.bdtopo.raw")
@@ -42,13 +106,17 @@ def execute(context):
         df_addresses = context.stage("data.ban.raw")[["geometry"]].copy()
         print("Number of addresses:", + len(df_addresses))
 
-        # Buffer buildings to capture adresses in their vicinity
-        df_buffer = df_buildings[["building_id", "housing", "geometry"]].copy()
-        df_buffer["geometry"] = df_buffer.buffer(context.config("home_address_buffer"))
+        if context.config("home_address_matching") == "buffer":
+            # Buffer buildings to capture adresses in their vicinity
+            df_buffer = df_buildings[["building_id", "housing", "geometry"]].copy()
+            df_buffer["geometry"] = df_buffer.buffer(context.config("home_address_buffer"))
+
+            # Find close-by addresses
+            df_addresses = gpd.sjoin(df_addresses, df_buffer, predicate = "within")[[
+                "building_id", "housing", "geometry"]]
 
-        # Find close-by addresses
-        df_addresses = gpd.sjoin(df_addresses, df_buffer, predicate = "within")[[
-            "building_id", "housing", "geometry"]]
+        else: # dwithin
+            df_addresses = match_within_distance(context, df_addresses, df_buildings)
     
     # Create missing addresses by using centroids
     df_missing = df_buildings[~df_buildings["building_id"].isin(df_addresses["building_id"])].copy()
@@ -72,3 +140,4 @@ def execute(context):
 def validate(context):
     assert context.config("home_location_source") in ("addresses", "buildings","tiles")
     assert context.config("home_location_weight") in ("uniform", "housing")
+    assert context.config("home_address_matching") in ("buffer", "dwithin")
@@ -22,6 +22,7 @@ def configure(context):
     context.config("output_path")
     context.config("output_prefix", "ile_de_france_")
     context.config("output_formats", ["csv", "gpkg"])
+    context.config("output_to_cache", False)
     
     if context.config("mode_choice", False):
         context.stage("matsim.simulation.prepare")
@@ -59,6 +60,10 @@ def clean_gpkg(path):
 
 def execute(context):
     output_path = context.config("output_path")
+
+    if context.config("output_to_cache"):
+        # Used by synthesis.partitioned_output to keep the files of a partition with its cache
+        output_path = context.path()
     output_prefix = context.config("output_prefix")
     output_formats = context.config("output_formats")
 
@@ -0,0 +1,129 @@
+import os, shutil
+import geopandas as gpd
+from synthesis.output import clean_gpkg
+from documentation.meta_output import write_information
+
+"""
+This stage writes the same output as synthesis.output, but creates the
+population in partitions of home departements. For each partition, all stages
+from synthesis.population.sampled to synthesis.output are run separately, so
+only the persons of one partition are held in memory at once. Stages that do
+not depend on the persons (HTS, OD matrices, destinations, ...) are only run
+once for all partitions. The output files of the partitions are written into
+their cache directories and are concatenated in the end.
+
+The households are sampled with the configured random seed, so they are the
+same as without partitions. The subsequent stages derive their own seed for
+every partition (see data.streams.get_random_seed), so that the partitions do
+not repeat the same random numbers.
+
+The partitions are given as a list, in which every entry is a departement or a
+list of departements. Every departement of the census must appear in exactly
+one partition:
+
+  output_partitions: ["75", ["77", "78"], ["91", "92", "93", "94", "95"]]
+"""
+
+# These files are the same for all partitions
+SHARED_FILES = ["vehicle_types.csv"]
+
+def get_partitions(context):
+    return [
+        [str(departement_id) for departement_id in departements] if isinstance(departements, list) else [str(departements)]
+        for departements in context.config("output_partitions")
+    ]
+
+def configure(context):
+    context.config("output_path")
+    context.config("output_prefix", "ile_de_france_")
+    context.config("output_formats", ["csv", "gpkg"])
+
+    context.stage("data.census.filtered")
+    context.stage("documentation.meta_output")
+
+    for index, departements in enumerate(get_partitions(context)):
+        context.stage("synthesis.output", dict(
+            home_departements = departements,
+            output_to_cache = True
+        ), alias = "partition_%d" % index)
+
+def validate(context):
+    for output_format in context.config("output_formats"):
+        if not output_format in ("csv", "gpkg"):
+            raise RuntimeError("Partitioned output does not support format: %s" % output_format)
+
+    partitions = get_partitions(context)
+
+    if len(partitions) == 0:
+        raise RuntimeError("At least one partition must be given in output_partitions")
+
+    known_departements = set()
+
+    for departements in partitions:
+        for departement_id in departements:
+            if departement_id in known_departements:
+                raise RuntimeError("Departement %s appears in more than one partition" % departement_id)
+
+            known_departements.add(departement_id)
+
+def execute(context):
+    output_path = context.config("output_path")
+    output_prefix = context.config("output_prefix")
+    partitions = get_partitions(context)
+
+    # Make sure that all households are covered by exactly one partition
+    census_departements = set(context.stage("data.census.filtered")["departement_id"].astype(str).unique())
+    missing_departements = sorted(census_departements - set(sum(partitions, [])))
+
+    if len(missing_departements) > 0:
+        raise RuntimeError("Departements not covered by any partition: %s" % ", ".join(missing_departements))
+
+    # Meta information is written only once and may come from the cache
+    write_information("%s/%smeta.json" % (output_path, output_prefix), context.stage("documentation.meta_output"))
+
+    # Find all files that have been written for the partitions
+    source_directories = [
+        context.path("partition_%d" % index) for index in range(len(partitions))
+    ]
+
+    names = sorted([
+        name[len(output_prefix):] for name in os.listdir(source_directories[0])
+        if name.startswith(output_prefix)
+    ])
+
+    if len(names) == 0:
+        raise RuntimeError("No output files found for the first partition in %s" % source_directories[0])
+
+    for name in context.progress(names, label = "Concatenating partitions ..."):
+        target_path = "%s/%s%s" % (output_path, output_prefix, name)
+
+        source_paths = [
+            "%s/%s%s" % (source_directory, output_prefix, name)
+            for source_directory in source_directories
+        ]
+
+        if os.path.exists(target_path):
+            os.remove(target_path)
+
+        if name in SHARED_FILES:
+            shutil.copy(source_paths[0], target_path)
+
+        elif name.endswith(".csv"):
+            with open(target_path, "wb+") as target:
+                for index, source_path in enumerate(source_paths):
+                    with open(source_path, "rb") as source:
+                        header = source.readline()
+                        if index == 0: target.write(header)
+                        shutil.copyfileobj(source, target)
+
+        elif name.endswith(".gpkg"):
+            for index, source_path in enumerate(source_paths):
+                df = gpd.read_file(source_path)
+
+                if index == 0 or len(df) > 0:
+                    df.to_file(target_path, driver = "GPKG", mode = "w" if index == 0 else "a")
+
+            clean_gpkg(target_path)
+
+        else:
+            raise RuntimeError("Don't know how to concatenate output file: %s" % name)
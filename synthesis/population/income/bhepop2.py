@@ -1,38 +1,121 @@
 import numpy as np
 import pandas as pd
-from synthesis.population.income.utils import income_uniform_sample, MAXIMUM_INCOME_FACTOR
+import hashlib
+import os
+import importlib.metadata
+from synthesis.population.income.utils import income_uniform_sample, partition_indices, MAXIMUM_INCOME_FACTOR
+import data.shared as shared
+import data.streams as streams
 from bhepop2.tools import add_household_size_attribute, add_household_type_attribute
 from bhepop2.sources.marginal_distributions import QuantitativeMarginalDistributions
 from bhepop2.enrichment.bhepop2 import Bhepop2Enrichment
 from bhepop2.utils import PopulationValidationError, SourceValidationError
+from bhepop2 import functions
+import bhepop2
 
 """
 This stage assigns a household income to each household of the synthesized
 population, using the method Bhepop2 described in the package of the same name.
 This method uses and fits the per-attribute distributions of Filosofi.
+
+Optionally, the fitted income distributions are cached in a separate directory
+per commune, identified by the Filosofi distributions of the commune and the
+frequencies of household sizes and compositions in its population. Subsequent
+runs with the same inputs then only sample from the cached distributions.
 """
 
 INCOME_COLUMN = "income"
 
+# The cache overrides private methods of Bhepop2Enrichment, so it is only used
+# with the versions of bhepop2 for which these methods are known
+CACHE_VERSIONS = ["2.0.0"]
+
 
 def configure(context):
     context.stage("data.income.municipality")
     context.stage("synthesis.population.sampled")
     context.stage("synthesis.population.spatial.home.zones")
 
-    context.config("random_seed")
+    streams.configure_seed(context)
+    context.config("bhepop2_cache_path", None)
+    shared.configure(context)
+
+
+def get_bhepop2_version():
+    version = getattr(bhepop2, "__version__", None)
+
+    if version is None:
+        version = importlib.metadata.version("bhepop2")
+
+    return version
+
+
+def use_cache(context):
+    return context.config("bhepop2_cache_path") is not None and get_bhepop2_version() in CACHE_VERSIONS
+
+
+def _hash_frame(df):
+    return pd.util.hash_pandas_object(df.reset_index(drop=True), index=False).values.tobytes()
+
+
+class CachedBhepop2Enrichment(Bhepop2Enrichment):
+    """
+    Bhepop2 enrichment that stores the fitted probabilities of the feature
+    classes per crossed modality on disk. The optimisation does not consume
+    random numbers, so the sampled values are the same with and without cache.
+
+    The class overrides the private methods _optimise and _get_feature_probs of
+    Bhepop2Enrichment, so it depends on the internals of bhepop2. It is only
+    used for the versions listed in CACHE_VERSIONS, otherwise the distributions
+    are fitted without cache.
+    """
+
+    def __init__(self, population, source, cache_path, key, **kwargs):
+        self.cache_path = cache_path
+        self.key = key
+        self.cache_file = None
+        self.cached_probs = None
+
+        super().__init__(population, source, **kwargs)
+
+    def _optimise(self):
+        crossed_modalities_frequencies = functions.compute_crossed_modalities_frequencies(
+            self.population, self.modalities
+        )
+
+        digest = hashlib.md5(self.key + _hash_frame(crossed_modalities_frequencies)).hexdigest()
+        self.cache_file = "{}/{}.p".format(self.cache_path, digest)
+
+        if os.path.exists(self.cache_file):
+            self.crossed_modalities_frequencies = crossed_modalities_frequencies
+            self.cached_probs = pd.read_pickle(self.cache_file)
+            return
+
+        return super()._optimise()
+
+    def _get_feature_probs(self):
+        if self.cached_probs is not None:
+            return self.cached_probs
+
+        probs = super()._get_feature_probs()
+
+        # write to a temporary file first, as several processes may use the cache
+        temporary_file = "{}.{}".format(self.cache_file, os.getpid())
+        pd.to_pickle(probs, temporary_file)
+        os.replace(temporary_file, self.cache_file)
+
+        return probs
 
 
 def _sample_income(context, args):
-    commune_id, random_seed = args
-    df_households, df_income = context.data("households"), context.data("income")
+    commune_id, random_seed, (household_start, household_end), (income_start, income_end) = args
+    df_households, df_income = shared.data(context, "households"), shared.data(context, "income")
 
     random = np.random.RandomState(random_seed)
 
-    # selection of commune population and distributions
-    f = df_households["commune_id"] == commune_id
-    df_selected = df_households[f].reset_index(drop=True)
-    distribs = df_income[df_income["commune_id"] == commune_id]
+    # selection of commune population and distributions, which are ordered by commune
+    df_selected = df_households.iloc[household_start:household_end].reset_index(drop=True)
+    distribs = df_income.iloc[income_start:income_end]
     distribs = distribs.rename(
         columns={
             "value": "modality",
@@ -63,7 +146,15 @@ def _sample_income(context, args):
         )
 
         # create enrichment class
-        enrich_class = Bhepop2Enrichment(df_selected, source, feature_name=INCOME_COLUMN, seed=random_seed)
+        cache_path = context.config("bhepop2_cache_path")
+
+        if not use_cache(context):
+            enrich_class = Bhepop2Enrichment(df_selected, source, feature_name=INCOME_COLUMN, seed=random_seed)
+        else:
+            key = str(commune_id).encode() + _hash_frame(distribs) + str(MAXIMUM_INCOME_FACTOR).encode()
+            enrich_class = CachedBhepop2Enrichment(
+                df_selected, source, cache_path, key, feature_name=INCOME_COLUMN, seed=random_seed
+            )
 
         # evaluate feature values on the population
         pop = enrich_class.assign_feature_values()
@@ -75,7 +166,7 @@ def _sample_income(context, args):
 
         # print(f"Successfully enriched population on commune {commune_id} using bhepop2")
         context.progress.update(1)
-        return f, incomes, "bhepop2"
+        return incomes, "bhepop2"
 
     # if those exceptions are raised, it is likely that some distributions were missing
     except (PopulationValidationError, SourceValidationError, ValueError) as e:
@@ -89,11 +180,11 @@ def _sample_income(context, args):
         incomes = income_uniform_sample(random, centiles, len(df_selected))
 
         context.progress.update(1)
-        return f, incomes, "uniform"
+        return incomes, "uniform"
 
 
 def execute(context):
-    random = np.random.RandomState(context.config("random_seed"))
+    random = np.random.RandomState(streams.get_random_seed(context))
 
     # Load data
     df_income = context.stage("data.income.municipality")
@@ -112,16 +203,43 @@ def execute(context):
 
     df_households = pd.merge(df_households, df_homes)
 
-    commune_ids = df_households["commune_id"].unique()
+    if use_cache(context):
+        os.makedirs(context.config("bhepop2_cache_path"), exist_ok=True)
+
+    elif context.config("bhepop2_cache_path") is not None:
+        print("Bhepop2 cache is not supported for bhepop2 %s, fitting distributions without cache" % get_bhepop2_version())
+
+    commune_indices, commune_ids = pd.factorize(df_households["commune_id"])
     random_seeds = random.randint(10000, size = len(commune_ids))
 
+    # Order households and distributions by commune, so workers only receive ranges
+    household_sorter, household_offsets = partition_indices(commune_indices, len(commune_ids))
+    df_sorted = df_households.iloc[household_sorter].reset_index(drop=True)
+
+    income_indices = pd.Index(np.asarray(commune_ids).astype(str)).get_indexer(df_income["commune_id"].astype(str))
+    df_income, income_indices = df_income[income_indices >= 0], income_indices[income_indices >= 0]
+
+    income_sorter, income_offsets = partition_indices(income_indices, len(commune_ids))
+    df_income = df_income.iloc[income_sorter]
+
+    household_ranges = list(zip(household_offsets[:-1], household_offsets[1:]))
+    income_ranges = list(zip(income_offsets[:-1], income_offsets[1:]))
+
     # Perform sampling per commune
+    incomes = np.zeros((len(df_households),))
+    methods = []
+
     with context.progress(label = "Imputing income ...", total = len(commune_ids)) as progress:
-        with context.parallel(dict(households = df_households, income = df_income)) as parallel:
+        with shared.publish(context, dict(households = df_sorted, income = df_income)) as data:
+            with context.parallel(data) as parallel:
+                arguments = zip(commune_ids, random_seeds, household_ranges, income_ranges)
+
+                for (start, end), (commune_incomes, method) in zip(household_ranges, parallel.imap(_sample_income, arguments)):
+                    incomes[household_sorter[start:end]] = commune_incomes
+                    methods.append(method)
 
-            for f, incomes, method in parallel.imap(_sample_income, zip(commune_ids, random_seeds)):
-                df_households.loc[f, "household_income"] = incomes * df_households.loc[f, "consumption_units"]
-                df_households.loc[f, "method"] = method
+    df_households["household_income"] = incomes * df_households["consumption_units"]
+    print("Communes imputed with bhepop2:", methods.count("bhepop2"), "/", len(methods))
 
     # Cleanup
     df_households = df_households[["household_id", "household_income", "consumption_units"]]
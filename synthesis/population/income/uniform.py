@@ -1,8 +1,7 @@
 import numpy as np
 import pandas as pd
-from synthesis.population.income.utils import income_uniform_sample
-import multiprocessing as mp
-from tqdm import tqdm
+import data.streams as streams
+from synthesis.population.income.utils import income_uniform_sample, income_uniform_sample_many, partition_indices
 
 """
 This stage assigns a household income to each household of the synthesized
@@ -10,6 +9,10 @@ population. For that it looks up the municipality of each household in the
 income database to obtain the municipality's income distribution (in centiles).
 Then, for each household, a centile is selected randomly from the respective
 income distribution and a random income within the selected stratum is chosen.
+
+By default, every municipality is sampled with its own random seed, one after
+another in the main process. With the vectorized sampling, the incomes of all households are drawn at once from one
+random stream, which is faster, but gives different values for a given seed.
 """
 
 def configure(context):
@@ -17,26 +20,13 @@ def configure(context):
     context.stage("synthesis.population.sampled")
     context.stage("synthesis.population.spatial.home.zones")
 
-    context.config("random_seed")
-
-
-def _sample_income(context, args):
-    commune_id, random_seed = args
-    df_households, df_income = context.data("households"), context.data("income")
-
-    random = np.random.RandomState(random_seed)
+    streams.configure_seed(context)
+    context.config("income_uniform_sampling", "communes")
 
-    f = df_households["commune_id"] == commune_id
-    df_selected = df_households[f]
-
-    centiles = list(df_income[df_income["commune_id"] == commune_id][["q1", "q2", "q3", "q4", "q5", "q6", "q7", "q8", "q9"]].iloc[0].values / 12)
-
-    incomes = income_uniform_sample(random, centiles, len(df_selected))
-
-    return f, incomes
+DECILES = ["q1", "q2", "q3", "q4", "q5", "q6", "q7", "q8", "q9"]
 
 def execute(context):
-    random = np.random.RandomState(context.config("random_seed"))
+    random = np.random.RandomState(streams.get_random_seed(context))
 
     # Load data
     df_income = context.stage("data.income.municipality")
@@ -52,13 +42,35 @@ def execute(context):
 
     df_households = pd.merge(df_households, df_homes)
 
-    # Perform sampling per commune
-    with context.parallel(dict(households = df_households, income = df_income)) as parallel:
-        commune_ids = df_households["commune_id"].unique()
+    # Look up the distribution of every household's commune
+    commune_indices, commune_ids = pd.factorize(df_households["commune_id"])
+
+    df_income = df_income.drop_duplicates("commune_id").set_index("commune_id")
+    deciles = df_income.loc[commune_ids, DECILES].values / 12
+
+    sampling = context.config("income_uniform_sampling")
+
+    if sampling == "communes":
+        # Perform sampling per commune, each with its own seed
         random_seeds = random.randint(10000, size = len(commune_ids))
 
-        for f, incomes in context.progress(parallel.imap(_sample_income, zip(commune_ids, random_seeds)), label = "Imputing income ...", total = len(commune_ids)):
-            df_households.loc[f, "household_income"] = incomes * df_households.loc[f, "consumption_units"]
+        sorter, offsets = partition_indices(commune_indices, len(commune_ids))
+
+        incomes = np.zeros((len(df_households),))
+
+        for index in context.progress(range(len(commune_ids)), label = "Imputing income ...", total = len(commune_ids)):
+            start, end = offsets[index], offsets[index + 1]
+
+            incomes[sorter[start:end]] = income_uniform_sample(
+                np.random.RandomState(random_seeds[index]), list(deciles[index]), end - start)
+
+    elif sampling == "vectorized":
+        incomes = income_uniform_sample_many(random, deciles, commune_indices)
+
+    else:
+        raise RuntimeError("Unknown income sampling: %s" % sampling)
+
+    df_households["household_income"] = incomes * df_households["consumption_units"]
 
     # Cleanup
     df_households = df_households[["household_id", "household_income", "consumption_units"]]
@@ -26,3 +26,45 @@ def income_uniform_sample(random_state, deciles, size):
     incomes = lower_bounds + random_state.random_sample(size=size) * (upper_bounds - lower_bounds)
 
     return incomes
+
+
+def income_uniform_sample_many(random_state, deciles, indices):
+    """
+    Draw income values from several decile distributions at once.
+
+    Same as income_uniform_sample, but one value is drawn for every entry of
+    indices, which selects the row of deciles to draw from.
+
+    :param random_state: numpy.random.RandomState
+    :param deciles: deciles values, one row per distribution
+    :param indices: distribution index for every income value
+    """
+    deciles = np.asarray(deciles, dtype=float)
+    deciles = np.hstack([
+        np.zeros((len(deciles), 1)), deciles, np.max(deciles, axis=1)[:, np.newaxis] * MAXIMUM_INCOME_FACTOR
+    ])
+
+    size = len(indices)
+    intervals = random_state.randint(10, size=size)
+    lower_bounds, upper_bounds = deciles[indices, intervals], deciles[indices, intervals + 1]
+
+    incomes = lower_bounds + random_state.random_sample(size=size) * (upper_bounds - lower_bounds)
+
+    return incomes
+
+
+def partition_indices(indices, count):
+    """
+    Partition entries by their group index.
+
+    Returns the positions of the entries ordered by group (keeping their
+    original order within a group) and the offsets of the groups, such that
+    the positions of group k are sorter[offsets[k]:offsets[k + 1]].
+
+    :param indices: group index for every entry
+    :param count: number of groups
+    """
+    sorter = np.argsort(indices, kind="stable")
+    offsets = np.hstack([[0], np.cumsum(np.bincount(indices, minlength=count))])
+
+    return sorter, offsets
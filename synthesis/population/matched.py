@@ -1,11 +1,12 @@
 from tqdm import tqdm
-import itertools
 import numpy as np
 import pandas as pd
-import numba
 
 import data.hts.egt.cleaned
 import data.hts.entd.cleaned
+import data.sampling as sampling
+import data.shared as shared
+import data.streams as streams
 
 import multiprocessing as mp
 
@@ -19,6 +20,8 @@ INCOME_CLASS = {
     "entd": data.hts.entd.cleaned.calculate_income_class,
 }
 
+STREAM_STAGE = "synthesis.population.matched"
+
 DEFAULT_MATCHING_ATTRIBUTES = [
     "sex", "any_cars", "age_class", "socioprofessional_class",
     "departement_id"
@@ -26,9 +29,14 @@ DEFAULT_MATCHING_ATTRIBUTES = [
 
 def configure(context):
     context.config("processes")
-    context.config("random_seed")
+    streams.configure_seed(context)
     context.config("matching_minimum_observations", 20)
     context.config("matching_attributes", DEFAULT_MATCHING_ATTRIBUTES)
+    shared.configure(context)
+    streams.configure(context)
+
+    if not context.config("matching_mode", "persons") in ("persons", "profiles"):
+        raise RuntimeError("Unknown matching mode: %s" % context.config("matching_mode"))
 
     context.stage("synthesis.population.sampled")
     context.stage("synthesis.population.income.selected")
@@ -36,16 +44,61 @@ def configure(context):
     hts = context.config("hts")
     context.stage("data.hts.selected", alias = "hts")
 
-@numba.jit(nopython = True) # Already parallelized parallel = True)
-def sample_indices(uniform, cdf, selected_indices):
-    indices = np.arange(len(uniform))
+def encode_matching_keys(df_source, df_target, columns):
+    """
+    Encodes the matching attributes of source and target into integer group
+    keys. One pair of key arrays is returned per matching level, where level
+    k is defined by the first k columns. Keys are compacted after every
+    column so that they never exceed the number of observations. A negative
+    key denotes an observation that cannot be matched on that level (missing
+    values).
+    """
+    source_count = len(df_source)
 
-    for i, u in enumerate(uniform):
-        indices[i] = np.count_nonzero(cdf < u)
+    keys = np.zeros((source_count + len(df_target),), dtype = np.int64)
+    levels = []
 
-    return selected_indices[indices]
-
-def statistical_matching(progress, df_source, source_identifier, weight, df_target, target_identifier, columns, random_seed = 0, minimum_observations = 0):
+    for column in columns:
+        codes, unique_values = pd.factorize(pd.concat([
+            df_source[column], df_target[column]
+        ], ignore_index = True))
+
+        invalid = (keys < 0) | (codes < 0)
+        keys, _ = pd.factorize(keys * len(unique_values) + codes)
+        keys[invalid] = -1
+
+        levels.append((keys[:source_count], keys[source_count:]))
+
+    return levels
+
+def find_matching_cells(source_keys, target_keys, target_indices):
+    """
+    Groups the given target observations and all source observations by their
+    keys. For every key that is present in both, a tuple with the sorted
+    source indices and the target indices of the cell is yielded.
+    """
+    source_sorter = np.argsort(source_keys, kind = "stable")
+    source_unique, source_start, source_counts = np.unique(
+        source_keys[source_sorter], return_index = True, return_counts = True)
+
+    target_keys = target_keys[target_indices]
+    target_sorter = np.argsort(target_keys, kind = "stable")
+    target_unique, target_start, target_counts = np.unique(
+        target_keys[target_sorter], return_index = True, return_counts = True)
+
+    # Only visit cells that are non-empty in source and target
+    target_selector = np.isin(target_unique, source_unique) & (target_unique >= 0)
+    source_positions = np.searchsorted(source_unique, target_unique[target_selector])
+
+    for source_position, start, count in zip(source_positions, target_start[target_selector], target_counts[target_selector]):
+        source_slice = slice(source_start[source_position], source_start[source_position] + source_counts[source_position])
+
+        yield (
+            source_sorter[source_slice],
+            target_indices[target_sorter[start:start + count]]
+        )
+
+def statistical_matching(progress, df_source, source_identifier, weight, df_target, target_identifier, columns, random_seed = 0, minimum_observations = 0, counter_streams = False):
     random = np.random.RandomState(random_seed)
 
     # Reduce data frames
@@ -56,64 +109,41 @@ def statistical_matching(progress, df_source, source_identifier, weight, df_targ
     df_source = df_source.sort_values(by = columns)
     df_target = df_target.sort_values(by = columns)
 
-    # Find unique values for all columns
-    unique_values = {}
-
-    for column in columns:
-        unique_values[column] = list(sorted(set(df_source[column].unique()) | set(df_target[column].unique())))
-
-    # Generate filters for all columns and values
-    source_filters, target_filters = {}, {}
-
-    for column, column_unique_values in unique_values.items():
-        source_filters[column] = [df_source[column].values == value for value in column_unique_values]
-        target_filters[column] = [df_target[column].values == value for value in column_unique_values]
-
-    # Define search order
-    source_filters = [source_filters[column] for column in columns]
-    target_filters = [target_filters[column] for column in columns]
+    # Encode attribute combinations as integer keys per level
+    level_keys = encode_matching_keys(df_source, df_target, columns)
 
     # Perform matching
     weights = df_source[weight].values
     assigned_indices = np.ones((len(df_target),), dtype = int) * -1
     unassigned_mask = np.ones((len(df_target),), dtype = bool)
     assigned_levels = np.ones((len(df_target),), dtype = int) * -1
-    uniform = random.random_sample(size = (len(df_target),))
-
-    column_indices = [np.arange(len(unique_values[column])) for column in columns]
 
-    for level in range(1, len(column_indices) + 1)[::-1]:
-        level_column_indices = column_indices[:level]
+    if counter_streams:
+        uniform = streams.sample_uniform(random_seed, STREAM_STAGE, df_target[target_identifier].values)
+    else:
+        uniform = random.random_sample(size = (len(df_target),))
 
-        if np.count_nonzero(unassigned_mask) > 0:
-            for column_index in itertools.product(*level_column_indices):
-                f_source = np.logical_and.reduce([source_filters[i][k] for i, k in enumerate(column_index)])
-                f_target = np.logical_and.reduce([target_filters[i][k] for i, k in enumerate(column_index)] + [unassigned_mask])
+    for level in range(1, len(columns) + 1)[::-1]:
+        source_keys, target_keys = level_keys[level - 1]
+        target_indices = np.flatnonzero(unassigned_mask)
 
-                selected_indices = np.nonzero(f_source)[0]
-                requested_samples = np.count_nonzero(f_target)
+        if len(target_indices) == 0:
+            break
 
-                if requested_samples == 0:
-                    continue
+        for selected_indices, selected_targets in find_matching_cells(source_keys, target_keys, target_indices):
+            if len(selected_indices) < minimum_observations:
+                continue
 
-                if len(selected_indices) < minimum_observations:
-                    continue
+            cdf = sampling.build_cdf(weights[selected_indices])
+            assigned_indices[selected_targets] = selected_indices[sampling.sample_indices(uniform[selected_targets], cdf)]
+            assigned_levels[selected_targets] = level
+            unassigned_mask[selected_targets] = False
 
-                selected_weights = weights[f_source]
-                cdf = np.cumsum(selected_weights)
-                cdf /= cdf[-1]
-
-                assigned_indices[f_target] = sample_indices(uniform[f_target], cdf, selected_indices)
-                assigned_levels[f_target] = level
-                unassigned_mask[f_target] = False
-
-                progress.update(np.count_nonzero(f_target))
+            progress.update(len(selected_targets))
 
     # Randomly assign unmatched observations
-    cdf = np.cumsum(weights)
-    cdf /= cdf[-1]
-
-    assigned_indices[unassigned_mask] = sample_indices(uniform[unassigned_mask], cdf, np.arange(len(weights)))
+    cdf = sampling.build_cdf(weights)
+    assigned_indices[unassigned_mask] = sampling.sample_indices(uniform[unassigned_mask], cdf)
     assigned_levels[unassigned_mask] = 0
 
     progress.update(np.count_nonzero(unassigned_mask))
@@ -130,35 +160,121 @@ def statistical_matching(progress, df_source, source_identifier, weight, df_targ
 
     return df_target, assigned_levels
 
+def profile_statistical_matching(progress, df_source, source_identifier, weight, df_target, target_identifier, columns, random_seed = 0, minimum_observations = 0, counter_streams = False):
+    """
+    Performs statistical matching on unique attribute profiles of the target
+    rather than on individual observations. The fallback levels are resolved
+    once per profile and all observations of a matching cell are drawn at
+    once from an alias table, so the effort of finding the cells scales with
+    the number of distinct profiles instead of the number of observations.
+    """
+    random = np.random.RandomState(random_seed)
+    uniform = None
+
+    if counter_streams:
+        uniform = streams.sample_uniform(random_seed, STREAM_STAGE, df_target[target_identifier].values)
+
+    # Reduce data frames
+    df_source = df_source[[source_identifier, weight] + columns].copy()
+    df_target = df_target[[target_identifier] + columns].copy()
+
+    df_source = df_source.sort_values(by = columns)
+
+    # Collapse target into unique profiles and group observations by profile
+    profile_ids = df_target.groupby(columns, dropna = False, sort = False).ngroup().values
+    _, representatives, profile_ids, profile_counts = np.unique(
+        profile_ids, return_index = True, return_inverse = True, return_counts = True)
+
+    profile_sorter = np.argsort(profile_ids, kind = "stable")
+    profile_offsets = np.hstack([[0], np.cumsum(profile_counts)])
+
+    print("  Matching {} profiles for {} observations".format(len(profile_counts), len(df_target)))
+
+    # Encode attribute combinations as integer keys per level
+    level_keys = encode_matching_keys(df_source, df_target.iloc[representatives], columns)
+
+    # Perform matching
+    weights = df_source[weight].values
+    assigned_indices = np.ones((len(df_target),), dtype = int) * -1
+    assigned_levels = np.ones((len(df_target),), dtype = int) * -1
+    unassigned_mask = np.ones((len(profile_counts),), dtype = bool)
+
+    for level in range(1, len(columns) + 1)[::-1]:
+        source_keys, profile_keys = level_keys[level - 1]
+        profile_indices = np.flatnonzero(unassigned_mask)
+
+        if len(profile_indices) == 0:
+            break
+
+        for selected_indices, selected_profiles in find_matching_cells(source_keys, profile_keys, profile_indices):
+            if len(selected_indices) < minimum_observations:
+                continue
+
+            selected_targets = profile_sorter[np.hstack([
+                np.arange(profile_offsets[profile], profile_offsets[profile + 1])
+                for profile in selected_profiles
+            ])]
+
+            probabilities, aliases = sampling.build_alias_table(weights[selected_indices])
+
+            if uniform is None:
+                indices = sampling.sample_alias(random.random_sample(size = len(selected_targets)), probabilities, aliases)
+            else:
+                indices = sampling.sample_alias(uniform[selected_targets], probabilities, aliases)
+
+            assigned_indices[selected_targets] = selected_indices[indices]
+            assigned_levels[selected_targets] = level
+            unassigned_mask[selected_profiles] = False
+
+            progress.update(len(selected_targets))
+
+    if np.count_nonzero(unassigned_mask) > 0:
+        raise RuntimeError("Some target observations could not be matched. Minimum observations configured too high?")
+
+    assert np.count_nonzero(assigned_indices == -1) == 0
+
+    # Write back indices
+    df_target[source_identifier] = df_source[source_identifier].values[assigned_indices]
+    df_target = df_target[[target_identifier, source_identifier]]
+
+    return df_target, assigned_levels
+
 def _run_parallel_statistical_matching(context, args):
     # Pass arguments
-    df_target, random_seed = args
+    df_target, random_seed, counter_streams = args
 
     # Pass data
-    df_source = context.data("df_source")
+    df_source = shared.data(context, "df_source")
     source_identifier = context.data("source_identifier")
     weight = context.data("weight")
     target_identifier = context.data("target_identifier")
     columns = context.data("columns")
     minimum_observations = context.data("minimum_observations")
 
-    return statistical_matching(context.progress, df_source, source_identifier, weight, df_target, target_identifier, columns, random_seed, minimum_observations)
+    return statistical_matching(context.progress, df_source, source_identifier, weight, df_target, target_identifier, columns, random_seed, minimum_observations, counter_streams)
 
 def parallel_statistical_matching(context, df_source, source_identifier, weight, df_target, target_identifier, columns, minimum_observations = 0):
-    random_seed = context.config("random_seed")
+    random_seed = streams.get_random_seed(context)
     processes = context.config("processes")
 
     random = np.random.RandomState(random_seed)
     chunks = np.array_split(df_target, processes)
 
     with context.progress(label = "Statistical matching ...", total = len(df_target)):
-        with context.parallel({
+        with shared.publish(context, {
             "df_source": df_source, "source_identifier": source_identifier, "weight": weight,
             "target_identifier": target_identifier, "columns": columns,
             "minimum_observations": minimum_observations
-        }) as parallel:
-                random_seeds = random.randint(10000, size = len(chunks))
-                results = parallel.map(_run_parallel_statistical_matching, zip(chunks, random_seeds))
+        }) as data:
+            with context.parallel(data) as parallel:
+                if streams.is_counter(context):
+                    # Every person draws from its own stream, so the chunks may be arbitrary
+                    arguments = [(chunk, random_seed, True) for chunk in chunks]
+                else:
+                    random_seeds = random.randint(10000, size = len(chunks))
+                    arguments = [(chunk, seed, False) for chunk, seed in zip(chunks, random_seeds)]
+
+                results = parallel.map(_run_parallel_statistical_matching, arguments)
 
                 levels = np.hstack([r[1] for r in results])
                 df_target = pd.concat([r[0] for r in results])
@@ -208,12 +324,24 @@ def execute(context):
         if not column in df_target:
             raise RuntimeError("Attribute not available in target (census) for matching: {}".format(column))
 
-    df_assignment, levels = parallel_statistical_matching(
-        context,
-        df_source, "hts_id", "person_weight",
-        df_target, "person_id",
-        columns,
-        minimum_observations = context.config("matching_minimum_observations"))
+    if context.config("matching_mode") == "profiles":
+        with context.progress(label = "Statistical matching of profiles ...", total = len(df_target)) as progress:
+            df_assignment, levels = profile_statistical_matching(
+                progress,
+                df_source, "hts_id", "person_weight",
+                df_target, "person_id",
+                columns,
+                random_seed = streams.get_random_seed(context),
+                minimum_observations = context.config("matching_minimum_observations"),
+                counter_streams = streams.is_counter(context))
+
+    else:
+        df_assignment, levels = parallel_statistical_matching(
+            context,
+            df_source, "hts_id", "person_weight",
+            df_target, "person_id",
+            columns,
+            minimum_observations = context.config("matching_minimum_observations"))
 
     df_target = pd.merge(df_target, df_assignment, on = "person_id")
     assert len(df_target) == len(df_assignment)
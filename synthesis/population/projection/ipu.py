@@ -1,109 +1,139 @@
 import pandas as pd
 import numpy as np
+import scipy.sparse as sparse
 
 """
 This stage reweights the census data set according to the projection data for a different year.
+
+The marginals are represented by a sparse matrix with one row per household and
+one column per constraint, which contains the number of persons of a household
+that count towards a constraint. It is constructed in one pass over all persons.
+Iterative Proportional Updating then works on the columns of this matrix.
 """
 
 def configure(context):
     context.stage("data.census.cleaned")
     context.stage("data.census.projection")
 
-def execute(context):
-    df_census = context.stage("data.census.cleaned")
-    projection = context.stage("data.census.projection")
+    context.config("projection_tolerance", 1e-3)
+    context.config("projection_maximum_iterations", 100)
 
-    # Adjust projection data (see below)
-    adjust_projection(projection)
+def create_incidence(df_census, projection, household_count):
+    """
+    Creates the sparse household x constraint matrix, the names of the
+    constraints and the target values.
+    """
+    household_indices = df_census["household_index"].values
+    ages = df_census["age"].values.astype(int)
+    sexes = df_census["sex"].astype(str).values
 
-    # Prepare indexing
-    df_households = df_census[["household_id", "household_size", "weight"]].drop_duplicates("household_id")
-    df_households["household_index"] = np.arange(len(df_households))
-    df_census = pd.merge(df_census, df_households[["household_id", "household_index"]])
+    f_valid = (ages > 0) & (ages <= 104)
 
-    # Obtain weights and sizes as arrays
-    household_weights = df_households["weight"].values
+    rows, columns, attributes, targets = [], [], [], []
+
+    def add_constraints(f, indices, names, values):
+        f = f & (indices >= 0)
 
-    # Obtain the attribute levels and membership of attributes for all households
-    attributes = []
+        rows.append(household_indices[f])
+        columns.append(len(attributes) + indices[f])
 
-    attribute_membership = []
-    attribute_counts = []
-    attribute_targets = []
+        attributes.extend(names)
+        targets.extend(values)
 
-    # Proccesing age ...
+    # Processing age ...
     df_marginal = projection["age"]
-    for index, row in context.progress(df_marginal.iterrows(), label = "Processing attribute: age", total = len(df_marginal)):
-        f = df_census["age"] == row["age"]
-        assert np.count_nonzero(f) > 0
-
-        df_counts = df_census.loc[f, "household_index"].value_counts()
-        attribute_targets.append(row["projection"])
-        attribute_membership.append(df_counts.index.values)
-        attribute_counts.append(df_counts.values)
-        attributes.append("age={}".format(row["age"]))
-    
+    marginal_ages = df_marginal["age"].values.astype(int)
+
+    add_constraints(np.ones((len(df_census),), dtype = bool),
+        pd.Index(marginal_ages).get_indexer(ages),
+        ["age={}".format(age) for age in marginal_ages], df_marginal["projection"].values)
+
     # Processing sex ...
     df_marginal = projection["sex"]
-    for index, row in context.progress(df_marginal.iterrows(), label = "Processing attribute: sex", total = len(df_marginal)):
-        f = df_census["sex"] == row["sex"]
-        f &= (df_census["age"] > 0) & (df_census["age"] <= 104)
-        assert np.count_nonzero(f) > 0
+    marginal_sexes = df_marginal["sex"].astype(str).values
 
-        df_counts = df_census.loc[f, "household_index"].value_counts()
-        attribute_targets.append(row["projection"])
-        attribute_membership.append(df_counts.index.values)
-        attribute_counts.append(df_counts.values)
-        attributes.append("sex={}".format(row["sex"]))
+    add_constraints(f_valid,
+        pd.Index(marginal_sexes).get_indexer(sexes),
+        ["sex={}".format(sex) for sex in marginal_sexes], df_marginal["projection"].values)
 
     # Processing age x sex ...
     df_marginal = projection["cross"]
-    for index, row in context.progress(df_marginal.iterrows(), label = "Processing attributes: sex x age", total = len(df_marginal)):
-        f = (df_census["sex"] == row["sex"]) & (df_census["age"] == row["age"])
-        assert np.count_nonzero(f) > 0
+    marginal_sexes = df_marginal["sex"].astype(str).values
+    marginal_ages = df_marginal["age"].values.astype(int)
 
-        df_counts = df_census.loc[f, "household_index"].value_counts()
-        attribute_targets.append(row["projection"])
-        attribute_membership.append(df_counts.index.values)
-        attribute_counts.append(df_counts.values)
-        attributes.append("sex={},age={}".format(row["sex"], row["age"]))
+    add_constraints(np.ones((len(df_census),), dtype = bool),
+        pd.MultiIndex.from_arrays([marginal_sexes, marginal_ages]).get_indexer(pd.MultiIndex.from_arrays([sexes, ages])),
+        ["sex={},age={}".format(sex, age) for sex, age in zip(marginal_sexes, marginal_ages)], df_marginal["projection"].values)
 
     # Processing total ...
-    f = (df_census["age"] > 0) & (df_census["age"] <= 104)
-    assert np.count_nonzero(f) > 0
-    
-    df_counts = df_census.loc[f, "household_index"].value_counts()
-    attribute_targets.append(projection["total"]["projection"].values[0])
-    attribute_membership.append(df_counts.index.values)
-    attribute_counts.append(df_counts.values)
-    attributes.append("total")
+    add_constraints(f_valid, np.zeros((len(df_census),), dtype = int),
+        ["total"], projection["total"]["projection"].values[:1])
 
-    # Perform IPU to obtain update weights
-    update = np.ones((len(df_households),))
+    rows, columns = np.hstack(rows), np.hstack(columns)
 
-    print("Starting IPU with {} attributes".format(len(attributes)))
-    convergence_threshold = 1e-3
-    maximum_iterations = 100
+    # Duplicate entries are summed up, so the matrix contains the person counts
+    incidence = sparse.csc_matrix((np.ones((len(rows),)), (rows, columns)), shape = (household_count, len(attributes)))
+
+    for attribute, count in zip(attributes, np.diff(incidence.indptr)):
+        assert count > 0, "No persons found for attribute {}".format(attribute)
+
+    return incidence, attributes, np.array(targets, dtype = float)
+
+def run_ipu(incidence, weights, targets, tolerance, maximum_iterations):
+    """
+    Performs Iterative Proportional Updating on the columns of the incidence
+    matrix and returns the update factors for all households.
+    """
+    update = np.ones((incidence.shape[0],))
+    converged = False
 
     for iteration in range(maximum_iterations):
-        factors = []    
-        for k in np.arange(len(attributes)):
-            selection = attribute_membership[k]
-        
-            target = attribute_targets[k]
-            current = np.sum(update[selection] * household_weights[selection] * attribute_counts[k])
-        
-            factor = target / current
-            factors.append(factor)
-                
-            update[selection] *= factor
-
-        print("IPU it={} min={} max={}".format(iteration, np.min(factors), np.max(factors)))
-
-        converged = np.abs(1 - np.max(factors)) < convergence_threshold
-        converged &= np.abs(1 - np.min(factors)) < convergence_threshold
+        factors = np.zeros((incidence.shape[1],))
+
+        for k in range(incidence.shape[1]):
+            start, end = incidence.indptr[k], incidence.indptr[k + 1]
+            selection = incidence.indices[start:end]
+
+            current = np.sum(update[selection] * weights[selection] * incidence.data[start:end])
+
+            factors[k] = targets[k] / current
+            update[selection] *= factors[k]
+
+        # Deviation of all constraints after the iteration
+        error = np.max(np.abs(incidence.T.dot(update * weights) / targets - 1.0))
+
+        print("IPU it={} min={} max={} error={}".format(iteration, np.min(factors), np.max(factors), error))
+
+        converged = np.abs(1 - np.max(factors)) < tolerance
+        converged &= np.abs(1 - np.min(factors)) < tolerance
         if converged: break
 
+    return update, converged
+
+def execute(context):
+    df_census = context.stage("data.census.cleaned")
+    projection = context.stage("data.census.projection")
+
+    # Adjust projection data (see below)
+    adjust_projection(projection)
+
+    # Prepare indexing
+    df_households = df_census[["household_id", "household_size", "weight"]].drop_duplicates("household_id")
+    df_households["household_index"] = np.arange(len(df_households))
+    df_census = pd.merge(df_census, df_households[["household_id", "household_index"]])
+
+    # Obtain weights and sizes as arrays
+    household_weights = df_households["weight"].values
+
+    # Obtain the membership of all households in the constraints
+    incidence, attributes, targets = create_incidence(df_census, projection, len(df_households))
+
+    # Perform IPU to obtain update weights
+    print("Starting IPU with {} attributes".format(len(attributes)))
+
+    update, converged = run_ipu(incidence, household_weights, targets,
+        context.config("projection_tolerance"), context.config("projection_maximum_iterations"))
+
     # Check that the applied factors in the last iteration are sufficiently small
     assert converged
 
@@ -1,11 +1,21 @@
 import numpy as np
 import pandas as pd
-import itertools
 
 """
 This stage has the census data as input and samples households according to the
 household weights given by INSEE. The resulting sample size can be controlled
 through the 'sampling_rate' configuration option.
+
+Every household is replicated according to its (stochastically rounded) weight
+and then every replica is selected with the sampling rate. Only the selected
+replicas are constructed, so memory and time depend on the size of the sample.
+Alternatively, the number of selected replicas of each household can be drawn
+directly from a binomial distribution.
+
+Optionally, only the households living in some departements are kept. They are
+selected after sampling, so the households and their identifiers are the same
+as in the population of all departements. This allows to process the population
+in partitions (see synthesis.partitioned_output).
 """
 
 def configure(context):
@@ -16,6 +26,8 @@ def configure(context):
 
     context.config("random_seed")
     context.config("sampling_rate")
+    context.config("household_sampling", "replicas")
+    context.config("home_departements", None)
 
 def execute(context):
     df_census = context.stage("source").sort_values(by = "household_id").copy()
@@ -24,7 +36,7 @@ def execute(context):
     random = np.random.RandomState(context.config("random_seed"))
 
     # Perform stochastic rounding for the population (and scale weights)
-    df_rounding = df_census[["household_id", "weight", "household_size"]].drop_duplicates("household_id")
+    df_rounding = df_census[["household_id", "weight", "household_size", "departement_id"]].drop_duplicates("household_id")
     df_rounding["multiplicator"] = np.floor(df_rounding["weight"])
     df_rounding["multiplicator"] += random.random_sample(len(df_rounding)) <= (df_rounding["weight"] - df_rounding["multiplicator"])
     df_rounding["multiplicator"] = df_rounding["multiplicator"].astype(int)
@@ -32,30 +44,63 @@ def execute(context):
     # Multiply households (use same multiplicator for all household members)
     household_multiplicators = df_rounding["multiplicator"].values
     household_sizes = df_rounding["household_size"].values
+    household_starts = np.cumsum(household_sizes) - household_sizes
+
+    if context.config("household_sampling") == "replicas":
+        # Select sample from the replicated households, by selecting replicas
+        # before constructing them. Replica r of the 100% population is the k-th
+        # replica of household h, and the new identifiers are based on the 100%
+        # population, as if it had been constructed.
+        household_count = np.sum(household_multiplicators)
+        replica_indices = np.flatnonzero(random.random_sample(household_count) < sampling_rate)
+
+        replica_ends = np.cumsum(household_multiplicators)
+        household_indices = np.searchsorted(replica_ends, replica_indices, side = "right")
+        replica_offsets = replica_indices - (replica_ends - household_multiplicators)[household_indices]
+
+        person_ends = np.cumsum(household_multiplicators * household_sizes)
+        person_offsets = person_ends - household_multiplicators * household_sizes
+        replica_person_starts = person_offsets[household_indices] + replica_offsets * household_sizes[household_indices]
+
+    elif context.config("household_sampling") == "binomial":
+        # Sample the number of replicas of every household directly
+        household_counts = random.binomial(household_multiplicators, sampling_rate)
+
+        household_indices = np.repeat(np.arange(len(household_counts)), household_counts)
+        replica_indices = np.arange(len(household_indices))
+
+        replica_sizes = household_sizes[household_indices]
+        replica_person_starts = np.cumsum(replica_sizes) - replica_sizes
 
-    # create index to replicate all households members by their household weight
+    else:
+        raise RuntimeError("Unknown household sampling: %s" % context.config("household_sampling"))
+
+    # Only keep households of the requested departements
+    if not context.config("home_departements") is None:
+        requested_departements = set(str(departement_id) for departement_id in context.config("home_departements"))
+        household_departements = df_rounding["departement_id"].astype(str).values
+
+        for departement_id in requested_departements:
+            if not departement_id in household_departements:
+                raise RuntimeError("No households found for departement %s" % departement_id)
+
+        f = np.isin(household_departements[household_indices], list(requested_departements))
+        household_indices, replica_indices, replica_person_starts = household_indices[f], replica_indices[f], replica_person_starts[f]
+
+    # Create index to replicate the members of the selected households
     # the order ([0, 1, 0, 1, 2, 2, ...]) is important here as they will be reassigned to new housholds later with that assumption
-    expandor = np.split(np.arange(len(df_census)), np.cumsum(household_sizes))
-    expandor = [x for x in expandor if x.size > 0]
-    expandor = np.repeat(expandor, household_multiplicators, axis=0)
-    expandor = list(itertools.chain(*expandor))
+    replica_sizes = household_sizes[household_indices]
+    person_offsets = np.arange(np.sum(replica_sizes)) - np.repeat(np.cumsum(replica_sizes) - replica_sizes, replica_sizes)
 
+    expandor = np.repeat(household_starts[household_indices], replica_sizes) + person_offsets
     df_census = df_census.iloc[expandor]
 
     # Create new household and person IDs
     df_census["census_person_id"] = df_census["person_id"]
     df_census["census_household_id"] = df_census["household_id"]
 
-    df_census["person_id"] = np.arange(len(df_census))
-
-    household_sizes = np.repeat(household_sizes, household_multiplicators)
-    household_count = np.sum(household_multiplicators)
-    df_census.loc[:, "household_id"] = np.repeat(np.arange(household_count), household_sizes)
-
-    # Select sample from 100% population
-    selector = random.random_sample(household_count) < sampling_rate
-    selector = np.repeat(selector, household_sizes)
-    df_census = df_census[selector]
+    df_census["person_id"] = np.repeat(replica_person_starts, replica_sizes) + person_offsets
+    df_census.loc[:, "household_id"] = np.repeat(replica_indices, replica_sizes)
 
     del df_census["weight"]
     return df_census
@@ -1,4 +1,5 @@
-import data.spatial.utils as spatial_utils
+import data.sampling as sampling
+import data.streams as streams
 import numpy as np
 import pandas as pd
 import geopandas as gpd
@@ -8,60 +9,59 @@ def configure(context):
     context.stage("synthesis.locations.home.locations")
     context.config("home_location_source", "addresses")
     
-    context.config("random_seed")
+    streams.configure_seed(context)
+    streams.configure(context)
 
-def _sample_locations(context, args):
-    # Extract data sets
-    df_locations = context.data("df_locations")
-    df_homes = context.data("df_homes")
+def execute(context):
+    random = np.random.RandomState(streams.get_random_seed(context))
 
-    # Extract task parameters
-    iris_id, random_seed = args
+    df_homes = context.stage("synthesis.population.spatial.home.zones")
+    df_locations = context.stage("synthesis.locations.home.locations")
 
-    # Select home candidates and locations for the selected IRIS
-    df_homes = df_homes[df_homes["iris_id"] == iris_id].copy()
-    df_locations = df_locations[df_locations["iris_id"] == iris_id].copy()
+    # Sort homes and candidate locations by IRIS, keeping the original order per IRIS
+    unique_iris_ids = sorted(set(df_homes["iris_id"].unique()))
+    seeds = random.randint(10000, size = len(unique_iris_ids))
 
-    # Verify counts
-    home_count = len(df_homes)
-    location_count = len(df_locations)
+    home_iris = pd.Index(unique_iris_ids).get_indexer(df_homes["iris_id"])
+    df_homes = df_homes.iloc[np.argsort(home_iris, kind = "stable")].copy()
+    home_iris = np.sort(home_iris)
 
-    assert location_count > 0
-    assert home_count > 0
+    location_iris = pd.Index(unique_iris_ids).get_indexer(df_locations["iris_id"])
+    f_relevant = location_iris >= 0
+    sorter = np.argsort(location_iris[f_relevant], kind = "stable")
+    df_locations = df_locations.iloc[np.flatnonzero(f_relevant)[sorter]]
+    location_iris = location_iris[f_relevant][sorter]
 
-    # Perform sampling
-    random = np.random.RandomState(random_seed)
+    home_counts = np.bincount(home_iris, minlength = len(unique_iris_ids))
+    location_counts = np.bincount(location_iris, minlength = len(unique_iris_ids))
+    assert np.all(location_counts > 0)
 
-    cdf = np.cumsum(df_locations["weight"].values)
-    cdf /= cdf[-1]
+    if streams.is_counter(context):
+        # Every household draws from its own stream
+        uniform = streams.sample_uniform(streams.get_random_seed(context),
+            "synthesis.population.spatial.home.locations", df_homes["household_id"].values)
 
-    indices = np.array([np.count_nonzero(cdf < u) 
-        for u in random.random_sample(size = home_count)])
-    
-    # Apply selection
-    df_homes["geometry"] = df_locations.iloc[indices]["geometry"].values
-    df_homes["home_location_id"] = df_locations.iloc[indices]["home_location_id"].values
-    
-    # Update progress
-    context.progress.update()
+    else:
+        # Draw the random numbers per IRIS as when sampling one IRIS after another
+        uniform = np.empty(len(df_homes))
+        home_offsets = np.hstack([[0], np.cumsum(home_counts)])
 
-    return gpd.GeoDataFrame(df_homes, crs = df_locations.crs)
+        with context.progress(label = "Sampling home locations ...", total = len(unique_iris_ids)) as progress:
+            for index, seed in enumerate(seeds):
+                random = np.random.RandomState(seed)
+                uniform[home_offsets[index]:home_offsets[index + 1]] = random.random_sample(size = home_counts[index])
+                progress.update()
 
-def execute(context):
-    random = np.random.RandomState(context.config("random_seed"))
+    # Sample all locations at once
+    location_offsets = np.hstack([[0], np.cumsum(location_counts)])
+    cdf = sampling.build_segmented_cdf(df_locations["weight"].values, location_offsets)
+    indices = sampling.sample_segmented(uniform, cdf, location_offsets, home_iris)
 
-    df_homes = context.stage("synthesis.population.spatial.home.zones")
-    df_locations = context.stage("synthesis.locations.home.locations")
-                   
-    # Sample locations for home
-    unique_iris_ids = sorted(set(df_homes["iris_id"].unique()))
+    # Apply selection
+    df_homes["geometry"] = df_locations["geometry"].values[indices]
+    df_homes["home_location_id"] = df_locations["home_location_id"].values[indices]
+    df_homes = gpd.GeoDataFrame(df_homes, crs = df_locations.crs)
 
-    with context.progress(label = "Sampling home locations ...", total = len(unique_iris_ids)):
-        with context.parallel(dict(
-            df_locations = df_locations, df_homes = df_homes
-        )) as parallel:
-            seeds = random.randint(10000, size = len(unique_iris_ids))
-            df_homes = pd.concat(parallel.map(_sample_locations, zip(unique_iris_ids, seeds)))
     out = ["household_id", "commune_id", "home_location_id", "geometry"]
         
     return df_homes[out]
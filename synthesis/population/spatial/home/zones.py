@@ -1,5 +1,7 @@
 import numpy as np
 import pandas as pd
+import data.sampling as sampling
+import data.streams as streams
 
 """
 This stage samples home zones for all synthesized households. From the census
@@ -19,10 +21,71 @@ def configure(context):
     context.stage("data.spatial.iris")
     context.stage("data.spatial.population")
 
-    context.config("random_seed")
+    streams.configure_seed(context)
+    context.config("home_zones_sampling", "multinomial")
+
+    if not context.config("home_zones_sampling") in ("multinomial", "segmented"):
+        raise RuntimeError("Unknown home zone sampling: %s" % context.config("home_zones_sampling"))
+
+def find_positions(keys):
+    return pd.Series(np.arange(len(keys))).groupby(np.asarray(keys), sort = False).indices
+
+def sample_candidates(random, groups, target_keys, candidate_keys, candidate_weights, mode, fill_zero_weights = False):
+    """
+    Samples for every target a candidate with the same key, proportionally to
+    the candidate weights. Returns the positions of the selected candidates.
+
+    In multinomial mode, the groups are processed one after another in the
+    given order, drawing the number of targets per candidate from a
+    multinomial distribution. In segmented mode, every target draws a
+    candidate independently and all groups are sampled at once.
+    """
+    target_positions = find_positions(target_keys)
+    candidate_positions = find_positions(candidate_keys)
+    empty = np.zeros((0,), dtype = int)
+
+    selection = np.zeros((len(target_keys),), dtype = int)
+
+    if mode == "multinomial":
+        for key in groups:
+            targets = target_positions[key]
+            candidates = candidate_positions.get(key, empty)
+
+            weights = candidate_weights[candidates].astype(float)
+            if fill_zero_weights and (weights == 0.0).all(): weights += 1.0
+            weights /= np.sum(weights)
+
+            indices = np.repeat(np.arange(weights.shape[0]), random.multinomial(len(targets), weights))
+            selection[targets] = candidates[indices]
+
+        return selection
+
+    groups = list(groups)
+    candidates = [candidate_positions.get(key, empty) for key in groups]
+
+    if any(len(item) == 0 for item in candidates):
+        raise RuntimeError("Some targets have no candidates to sample from")
+
+    offsets = np.hstack([[0], np.cumsum([len(item) for item in candidates])])
+    candidates = np.hstack(candidates)
+
+    weights = candidate_weights[candidates].astype(float)
+
+    if fill_zero_weights:
+        f_zero = np.add.reduceat(weights, offsets[:-1]) == 0.0
+        weights[np.repeat(f_zero, np.diff(offsets))] = 1.0
+
+    cdf = sampling.build_segmented_cdf(weights, offsets)
+
+    targets = np.hstack([target_positions[key] for key in groups])
+    segments = np.repeat(np.arange(len(groups)), [len(target_positions[key]) for key in groups])
+
+    selection[targets] = candidates[sampling.sample_segmented(random.random_sample(len(targets)), cdf, offsets, segments)]
+    return selection
 
 def execute(context):
-    random = np.random.RandomState(context.config("random_seed"))
+    random = np.random.RandomState(streams.get_random_seed(context))
+    mode = context.config("home_zones_sampling")
 
     df_households = context.stage("synthesis.population.sampled").drop_duplicates("household_id")[[
         "household_id", "commune_id", "iris_id", "departement_id"
@@ -39,23 +102,15 @@ def execute(context):
         sorted(set(df_municipalities.index.unique()) - set(df_households["commune_id"].cat.categories)))
 
     departements = df_households[~f_has_commune]["departement_id"].unique()
+    df_candidates = df_municipalities[~df_municipalities["has_iris"]]
 
-    for departement_id in context.progress(departements, label = "Fixing missing communes ..."):
-        df_candidates = df_municipalities[
-            ~df_municipalities["has_iris"] &
-            (df_municipalities["departement_id"].astype(str) == departement_id)]
-
-        df_target = df_households[
-            ~f_has_commune &
-            (df_households["departement_id"] == departement_id)].copy()
+    selection = sample_candidates(
+        random, context.progress(departements, label = "Fixing missing communes ..."),
+        df_households["departement_id"].values[~f_has_commune.values],
+        df_candidates["departement_id"].astype(str).values,
+        df_candidates["population"].values, mode)
 
-        weights = df_candidates["population"].values.astype(float)
-        weights /= np.sum(weights)
-
-        indices = np.repeat(np.arange(weights.shape[0]), random.multinomial(len(df_target), weights))
-        df_target["commune_id"] = df_candidates.reset_index()["commune_id"].iloc[indices].values
-
-        df_households.loc[df_target.index, "commune_id"] = df_target["commune_id"]
+    df_households.loc[~f_has_commune, "commune_id"] = df_candidates.index.values[selection]
 
     # Fix missing IRIS (we select from those with <200 inhabitants)
     df_iris = context.stage("data.spatial.iris").set_index("iris_id")
@@ -65,24 +120,15 @@ def execute(context):
         sorted(set(df_iris.index.unique()) - set(df_households["iris_id"].cat.categories)))
 
     communes = df_households[~f_has_iris & f_has_commune]["commune_id"].unique()
+    df_candidates = df_iris[df_iris["population"] <= 200]
 
-    for commune_id in context.progress(communes, label = "Fixing missing IRIS ..."):
-        df_candidates = df_iris[
-            (df_iris["population"] <= 200) &
-            (df_iris["commune_id"].astype(str) == commune_id)]
-
-        df_target = df_households[
-            f_has_commune & ~f_has_iris &
-            (df_households["commune_id"] == commune_id)].copy()
-
-        weights = df_candidates["population"].values.astype(float)
-        if (weights == 0.0).all(): weights += 1.0
-        weights /= np.sum(weights)
-
-        indices = np.repeat(np.arange(weights.shape[0]), random.multinomial(len(df_target), weights))
-        df_target["iris_id"] = df_candidates.reset_index()["iris_id"].iloc[indices].values
+    selection = sample_candidates(
+        random, context.progress(communes, label = "Fixing missing IRIS ..."),
+        df_households["commune_id"].values[~f_has_iris.values & f_has_commune.values],
+        df_candidates["commune_id"].astype(str).values,
+        df_candidates["population"].values, mode, fill_zero_weights = True)
 
-        df_households.loc[df_target.index, "iris_id"] = df_target["iris_id"]
+    df_households.loc[~f_has_iris & f_has_commune, "iris_id"] = df_candidates.index.values[selection]
 
     # Check that everybody has a commune now
     assert np.count_nonzero(df_households["commune_id"] == "undefined") == 0
@@ -1,5 +1,7 @@
 import pandas as pd
 import numpy as np
+import data.shared as shared
+import data.streams as streams
 
 def configure(context):
     context.stage("data.od.weighted")
@@ -12,8 +14,12 @@ def configure(context):
     context.stage("synthesis.population.trips")
 
     context.config("output_path")
-    context.config("random_seed")
+    streams.configure_seed(context)
     context.config("education_location_source", "bpe")
+    shared.configure(context)
+    streams.configure(context)
+
+STREAM_STAGE = "synthesis.population.spatial.primary.candidates"
 
 EDUCATION_MAPPING = {
     "primary_school": ["C1"],
@@ -21,14 +27,31 @@ EDUCATION_MAPPING = {
     "high_school": ["C3"],
     "higher_education": ["C4", "C5", "C6"]}
 
+def create_offsets(df, column):
+    """
+    Sorts the data frame by the given column, keeping the order of the rows
+    with the same value, and returns it together with the range of rows for
+    every value. Slicing a range gives the same result as filtering the
+    original data frame by the value.
+    """
+    df = df.sort_values(column, kind = "stable")
+    codes, values = pd.factorize(df[column])
+
+    starts = np.flatnonzero(np.hstack([[True], codes[1:] != codes[:-1]]))
+    ends = np.hstack([starts[1:], [len(df)]])
+
+    return df, {
+        values[code]: (start, end) for code, start, end in zip(codes[starts], starts, ends) if code >= 0
+    }
+
 def sample_destination_municipalities(context, arguments):
     # Load data
-    origin_id, count, random_seed = arguments
-    df_od = context.data("df_od")
+    origin_id, count, random_seed, start, end = arguments
+    df_od = shared.data(context, "df_od")
 
     # Prepare state
     random = np.random.RandomState(random_seed)
-    df_od = df_od[df_od["origin_id"] == origin_id].copy()
+    df_od = df_od.iloc[start:end].copy()
 
     # Sample destinations
     df_od["count"] = random.multinomial(count, df_od["weight"].values)
@@ -39,15 +62,15 @@ def sample_destination_municipalities(context, arguments):
 
 def sample_locations(context, arguments):
     # Load data
-    destination_id, random_seed = arguments
-    df_locations, df_flow = context.data("df_locations"), context.data("df_flow")
+    destination_id, random_seed, location_range, flow_range = arguments
+    df_locations, df_flow = shared.data(context, "df_locations"), shared.data(context, "df_flow")
 
     # Prepare state
     random = np.random.RandomState(random_seed)
-    df_locations = df_locations[df_locations["commune_id"] == destination_id]
+    df_locations = df_locations.iloc[location_range[0]:location_range[1]]
     
     # Determine demand
-    df_flow = df_flow[df_flow["destination_id"] == destination_id]
+    df_flow = df_flow.iloc[flow_range[0]:flow_range[1]]
     count = df_flow["count"].sum()
 
     # Sample destinations
@@ -75,34 +98,63 @@ def sample_locations(context, arguments):
 
     return df_result
 
+def create_random_seeds(context, random, step_name, commune_ids):
+    # With counter-based random streams, every commune obtains its own stream
+    if streams.is_counter(context):
+        return [
+            streams.create_bit_generator(streams.get_random_seed(context), "%s.%s" % (STREAM_STAGE, step_name), commune_id)
+            for commune_id in commune_ids
+        ]
+
+    return random.randint(0, int(1e6), len(commune_ids))
+
 def process(context, purpose, random, df_persons, df_od, df_locations,step_name):
     df_persons = df_persons[df_persons["has_%s_trip" % purpose]]
 
     # Sample commute flows based on population
     df_demand = df_persons.groupby("commune_id").size().reset_index(name = "count")
-    df_demand["random_seed"] = random.randint(0, int(1e6), len(df_demand))
+    df_demand["random_seed"] = create_random_seeds(context, random, step_name + ".origins", df_demand["commune_id"].values)
     df_demand = df_demand[["commune_id", "count", "random_seed"]]
     df_demand = df_demand[df_demand["count"] > 0]
 
+    # Index the OD matrix by origin
+    df_od, od_offsets = create_offsets(df_od, "origin_id")
+    od_ranges = [od_offsets.get(origin_id, (0, 0)) for origin_id in df_demand["commune_id"]]
+
+    arguments = [
+        (origin_id, count, random_seed, start, end)
+        for (origin_id, count, random_seed), (start, end)
+        in zip(df_demand.itertuples(index = False, name = None), od_ranges)
+    ]
+
     df_flow = []
 
     with context.progress(label = "Sampling %s municipalities" % step_name, total = len(df_demand)) as progress:
-        with context.parallel(dict(df_od = df_od)) as parallel:
-            for df_partial in parallel.imap_unordered(sample_destination_municipalities, df_demand.itertuples(index = False, name = None)):
-                df_flow.append(df_partial)
+        with shared.publish(context, dict(df_od = df_od)) as data:
+            with context.parallel(data) as parallel:
+                for df_partial in parallel.imap_unordered(sample_destination_municipalities, arguments):
+                    df_flow.append(df_partial)
 
     df_flow = pd.concat(df_flow).sort_values(["origin_id", "destination_id"])
 
     # Sample destinations based on the obtained flows
     unique_ids = df_flow["destination_id"].unique()
-    random_seeds = random.randint(0, int(1e6), len(unique_ids))
+    random_seeds = create_random_seeds(context, random, step_name + ".destinations", unique_ids)
+
+    # Index locations and flows by destination
+    df_locations, location_offsets = create_offsets(df_locations, "commune_id")
+    df_flow, flow_offsets = create_offsets(df_flow, "destination_id")
+
+    location_ranges = [location_offsets.get(destination_id, (0, 0)) for destination_id in unique_ids]
+    flow_ranges = [flow_offsets[destination_id] for destination_id in unique_ids]
 
     df_result = []
 
     with context.progress(label = "Sampling %s destinations" % purpose, total = len(df_demand)) as progress:
-        with context.parallel(dict(df_locations = df_locations, df_flow = df_flow)) as parallel:
-            for df_partial in parallel.imap_unordered(sample_locations, zip(unique_ids, random_seeds)):
-                df_result.append(df_partial)
+        with shared.publish(context, dict(df_locations = df_locations, df_flow = df_flow)) as data:
+            with context.parallel(data) as parallel:
+                for df_partial in parallel.imap_unordered(sample_locations, zip(unique_ids, random_seeds, location_ranges, flow_ranges)):
+                    df_result.append(df_partial)
 
     df_result = pd.concat(df_result).sort_values(["origin_id", "destination_id"])
 
@@ -128,7 +180,7 @@ def execute(context):
     df_work_od, df_education_od = context.stage("data.od.weighted")
 
     # Sampling
-    random = np.random.RandomState(context.config("random_seed"))
+    random = np.random.RandomState(streams.get_random_seed(context))
 
     df_locations = context.stage("synthesis.locations.work")
     df_locations["weight"] = df_locations["employees"]
@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
 import geopandas as gpd
+import scipy.spatial
+import data.shared as shared
 from .candidates import EDUCATION_MAPPING
 
 def configure(context):
@@ -11,6 +13,11 @@ def configure(context):
     context.stage("synthesis.locations.education")
 
     context.config("education_location_source", "bpe")
+    context.config("primary_location_ordering", "greedy")
+    shared.configure(context)
+
+    if not context.config("primary_location_ordering") in ORDERINGS:
+        raise RuntimeError("Unknown primary location ordering: %s" % context.config("primary_location_ordering"))
 
 
 def define_distance_ordering(df_persons, df_candidates, progress):
@@ -44,21 +51,103 @@ def define_random_ordering(df_persons, df_candidates, progress):
     progress.update(len(df_candidates))
     return np.arange(len(df_candidates))
 
-define_ordering = define_distance_ordering
+def define_knn_ordering(df_persons, df_candidates, progress, probes = 16, neighbors = 8):
+    """
+    Approximates define_distance_ordering: Instead of evaluating all available
+    candidates for every person, only the nearest neighbors of a number of
+    probe points on the circle with the commute distance around the home
+    location are evaluated.
+
+    Candidates are sampled with replacement from the locations, so many of them
+    share the same coordinates. The spatial index is therefore built over the
+    distinct sites, which keep the number of candidates that remain to be
+    assigned. A site is removed once all of its candidates are assigned, and the
+    index is rebuilt over the remaining sites whenever half of its sites have
+    been removed. If none of the neighbors is available anymore, the number of
+    neighbors is increased until an available site is found.
+    """
+    commute_coordinates = np.vstack([
+        df_candidates["geometry"].x.values,
+        df_candidates["geometry"].y.values
+    ]).T
+
+    # Group the candidates by site, candidates of a site are assigned in their original order
+    site_coordinates, site_indices = np.unique(commute_coordinates, axis = 0, return_inverse = True)
+    site_indices = site_indices.reshape(-1)
+
+    site_sorter = np.argsort(site_indices, kind = "stable")
+    site_counts = np.bincount(site_indices, minlength = len(site_coordinates))
+    site_next = np.hstack([[0], np.cumsum(site_counts)[:-1]])
+
+    f_available = site_counts > 0
+    remaining = len(site_coordinates)
+
+    tree_indices = np.arange(len(site_coordinates))
+    tree = scipy.spatial.cKDTree(site_coordinates)
+
+    home_locations = gpd.GeoSeries(df_persons["home_location"].values)
+    home_coordinates = np.vstack([home_locations.x.values, home_locations.y.values]).T
+
+    angles = np.arange(probes) * 2.0 * np.pi / probes
+    ring = np.vstack([np.cos(angles), np.sin(angles)]).T
+
+    indices = []
+
+    for home_coordinate, commute_distance in zip(home_coordinates, df_persons["commute_distance"].values):
+        probe_coordinates = home_coordinate + ring * commute_distance
+        k = min(neighbors, len(tree_indices))
+
+        while True:
+            found = tree.query(probe_coordinates, k = k)[1]
+            found = np.unique(tree_indices[found.reshape(-1)])
+            found = found[f_available[found]]
+
+            if len(found) > 0 or k == len(tree_indices):
+                break
+
+            k = min(2 * k, len(tree_indices))
+
+        distances = np.sqrt(np.sum((site_coordinates[found] - home_coordinate)**2, axis = 1))
+        selected_site = found[np.argmin(np.abs(distances - commute_distance))]
+
+        indices.append(site_sorter[site_next[selected_site]])
+        site_next[selected_site] += 1
+        site_counts[selected_site] -= 1
+
+        if site_counts[selected_site] == 0:
+            f_available[selected_site] = False
+            remaining -= 1
+
+            # All remaining sites are in the index, rebuild it without the removed ones
+            if remaining > 0 and remaining <= len(tree_indices) // 2:
+                tree_indices = np.where(f_available)[0]
+                tree = scipy.spatial.cKDTree(site_coordinates[tree_indices])
+
+        progress.update()
+
+    assert len(set(indices)) == len(df_candidates)
+
+    return indices
+
+ORDERINGS = dict(
+    greedy = define_distance_ordering,
+    knn = define_knn_ordering
+)
 
 def process_municipality(context, origin_id):
     # Load data
-    df_candidates, df_persons = context.data("df_candidates"), context.data("df_persons")
+    df_candidates, df_persons = shared.data(context, "df_candidates"), shared.data(context, "df_persons")
 
     # Find relevant records
-    df_persons = df_persons[df_persons["commune_id"] == origin_id][[
+    df_persons = shared.points(df_persons[df_persons["commune_id"] == origin_id], ["home_location"])[[
         "person_id", "home_location", "commute_distance"
     ]].copy()
-    df_candidates = df_candidates[df_candidates["origin_id"] == origin_id]
+    df_candidates = shared.points(df_candidates[df_candidates["origin_id"] == origin_id])
 
     # From previous step, this should be equal!
     assert len(df_persons) == len(df_candidates)
 
+    define_ordering = ORDERINGS[context.config("primary_location_ordering")]
     indices = define_ordering(df_persons, df_candidates, context.progress)
     df_candidates = df_candidates.iloc[indices]
 
@@ -73,9 +162,10 @@ def process(context, purpose, df_persons, df_candidates):
     df_result = []
 
     with context.progress(label = "Distributing %s destinations" % purpose, total = len(df_persons)) as progress:
-        with context.parallel(dict(df_persons = df_persons, df_candidates = df_candidates)) as parallel:
-            for df_partial in parallel.imap_unordered(process_municipality, unique_ids):
-                df_result.append(df_partial)
+        with shared.publish(context, dict(df_persons = df_persons, df_candidates = df_candidates)) as data:
+            with context.parallel(data) as parallel:
+                for df_partial in parallel.imap_unordered(process_municipality, unique_ids):
+                    df_result.append(df_partial)
 
     return pd.concat(df_result).sort_index()
 
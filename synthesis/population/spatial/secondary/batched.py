@@ -0,0 +1,344 @@
+import numpy as np
+import numpy.linalg as la
+import pandas as pd
+
+import synthesis.population.spatial.secondary.distance_distributions as distance_distributions
+import synthesis.population.spatial.secondary.rda as rda
+
+"""
+Batched version of the secondary location assignment. Instead of solving one
+problem after another, problems of the same shape (kind of chain and number of
+variable activities) are stacked into arrays and all steps of the assignment
+(distance sampling, relaxation, discretization and evaluation of the objective)
+are performed on the whole batch at once. Problems that have converged are
+removed from the batch, the others continue with the next iteration.
+
+The algorithm follows the sequential AssignmentSolver with the same components
+as set up in synthesis.population.spatial.secondary.locations. Since random
+numbers are drawn in a different order, the outcome differs from the
+sequential solver for the same random seed.
+"""
+
+CHAIN, LEFT_TAIL, RIGHT_TAIL, FREE = "chain", "left_tail", "right_tail", "free"
+
+def get_problem_kinds(table):
+    kinds = np.full(len(table["size"]), FREE, dtype = object)
+    kinds[~table["has_origin"] & table["has_destination"]] = LEFT_TAIL
+    kinds[table["has_origin"] & ~table["has_destination"]] = RIGHT_TAIL
+    kinds[table["has_origin"] & table["has_destination"]] = CHAIN
+    return kinds
+
+class ProblemBatch:
+    def __init__(self, table, indices, kind, size, mode_indices):
+        self.kind = kind
+        self.size = size
+        self.count = len(indices)
+
+        trips = table["trip_offsets"][indices][:, np.newaxis] + np.arange(table["trip_offsets"][indices[0] + 1] - table["trip_offsets"][indices[0]])
+        activities = table["purpose_offsets"][indices][:, np.newaxis] + np.arange(size)
+
+        self.modes = mode_indices.get_indexer(table["modes"][trips.reshape(-1)]).reshape(trips.shape)
+        assert not np.any(self.modes < 0)
+        self.travel_times = table["travel_times"][trips].astype(float)
+        self.purposes = table["purposes"][activities]
+
+        self.origins = table["origin"][indices] if kind in (CHAIN, RIGHT_TAIL) else None
+        self.destinations = table["destination"][indices] if kind in (CHAIN, LEFT_TAIL) else None
+
+class BatchedAssignmentSolver:
+    def __init__(self, random, tables, index, thresholds, maximum_iterations = 20,
+        maximum_distance_iterations = 1000, maximum_relaxation_iterations = 1000,
+        lateral_deviation = 10.0, alpha = 0.3, eps = 1e-2):
+
+        self.random = random
+        self.tables = tables
+        self.index = index
+
+        self.mode_indices = pd.Index(tables["modes"])
+        self.thresholds = np.array([thresholds[mode] for mode in tables["modes"]])
+
+        self.maximum_iterations = int(maximum_iterations)
+        self.maximum_distance_iterations = int(maximum_distance_iterations)
+        self.maximum_relaxation_iterations = int(maximum_relaxation_iterations)
+
+        self.lateral_deviation = lateral_deviation
+        self.alpha = alpha
+        self.eps = eps
+
+    def solve(self, table):
+        """
+        Solves the assignment problems of a problem table (see
+        problems.find_problem_table). Returns, per batch of problems with the
+        same shape, the indices of the problems in the table, the location
+        identifiers and locations per variable activity and whether the
+        assignment is valid.
+        """
+        kinds = get_problem_kinds(table)
+        results = []
+
+        for kind in (CHAIN, LEFT_TAIL, RIGHT_TAIL, FREE):
+            for size in np.unique(table["size"][kinds == kind]):
+                indices = np.where((kinds == kind) & (table["size"] == size))[0]
+
+                batch = ProblemBatch(table, indices, kind, size, self.mode_indices)
+                result = self.solve_batch(batch)
+                result["indices"] = indices
+                results.append(result)
+
+        return results
+
+    def solve_batch(self, batch):
+        best_objectives = np.full(batch.count, np.inf)
+        best_valid = np.zeros(batch.count, dtype = bool)
+        best_identifiers = None
+        best_locations = np.zeros((batch.count, batch.size, 2))
+
+        active = np.arange(batch.count)
+
+        for assignment_iteration in range(self.maximum_iterations):
+            distances, distance_valid = self.sample_distances(batch, active)
+            locations, relaxation_valid = self.relax(batch, active, distances)
+            identifiers, discretized_locations = self.discretize(batch, active, locations)
+            objectives = self.evaluate(batch, active, distances, discretized_locations)
+
+            valid = (objectives == 0.0) & distance_valid & relaxation_valid
+
+            if best_identifiers is None:
+                best_identifiers = np.empty((batch.count, batch.size), dtype = identifiers.dtype)
+
+            f = objectives < best_objectives[active]
+            selection = active[f]
+
+            best_objectives[selection] = objectives[f]
+            best_valid[selection] = valid[f]
+            best_identifiers[selection] = identifiers[f]
+            best_locations[selection] = discretized_locations[f]
+
+            active = active[~best_valid[active]]
+
+            if len(active) == 0:
+                break
+
+        return dict(
+            identifiers = best_identifiers, locations = best_locations, valid = best_valid
+        )
+
+    def draw_distances(self, batch, rows):
+        modes = batch.modes[rows].reshape(-1)
+        travel_times = batch.travel_times[rows].reshape(-1)
+        uniform = self.random.random_sample(len(modes))
+
+        distances = distance_distributions.sample_from_tables(self.tables, modes, travel_times, uniform)
+        return distances.reshape(len(rows), -1)
+
+    def sample_distances(self, batch, active):
+        if batch.kind != CHAIN: # Tails and free chains
+            return self.draw_distances(batch, active), np.ones(len(active), dtype = bool)
+
+        direct_distances = la.norm(batch.destinations[active] - batch.origins[active], axis = 1)
+
+        # One point and two trips with the same origin and destination
+        if batch.size == 1:
+            f_loop = direct_distances < 1e-3
+        else:
+            f_loop = np.zeros(len(active), dtype = bool)
+
+        # Sample until the distances are feasible or the iterations are exhausted
+        best_distances = self.draw_distances(batch, active)
+        best_deltas = rda.calculate_feasibility_many(best_distances, direct_distances)
+        best_deltas[f_loop] = 0.0
+
+        pending = np.where(best_deltas > 0.0)[0]
+
+        for k in range(1, self.maximum_distance_iterations):
+            if len(pending) == 0:
+                break
+
+            distances = self.draw_distances(batch, active[pending])
+            deltas = rda.calculate_feasibility_many(distances, direct_distances[pending])
+
+            f = deltas < best_deltas[pending]
+            best_distances[pending[f]] = distances[f]
+            best_deltas[pending[f]] = deltas[f]
+
+            pending = pending[best_deltas[pending] > 0.0]
+
+        best_distances[f_loop, 1] = best_distances[f_loop, 0]
+
+        return best_distances, best_deltas == 0.0
+
+    def relax(self, batch, active, distances):
+        if batch.kind == CHAIN:
+            return self.relax_chains(batch, active, distances)
+
+        elif batch.kind == FREE:
+            anchors = self.sample_anchors(batch, active)
+            locations = self.sample_tails(anchors, distances)
+            locations = np.concatenate([anchors[:, np.newaxis, :], locations], axis = 1)
+            return locations, np.ones(len(active), dtype = bool)
+
+        elif batch.kind == LEFT_TAIL:
+            locations = self.sample_tails(batch.destinations[active], distances)
+            return locations, np.ones(len(active), dtype = bool)
+
+        else: # RIGHT_TAIL
+            locations = self.sample_tails(batch.origins[active], distances)
+            return locations[:, ::-1, :], np.ones(len(active), dtype = bool)
+
+    def sample_anchors(self, batch, active):
+        purposes = batch.purposes[active, 0]
+        anchors = np.zeros((len(active), 2))
+
+        for purpose in np.unique(purposes):
+            f = purposes == purpose
+            anchors[f] = self.index.sample_many(purpose, self.random, np.count_nonzero(f))[1]
+
+        return anchors
+
+    def sample_tails(self, anchors, distances):
+        angles = self.random.random_sample(distances.shape) * 2.0 * np.pi
+        offsets = np.stack([np.cos(angles), np.sin(angles)], axis = 2) * distances[:, :, np.newaxis]
+        return anchors[:, np.newaxis, :] + np.cumsum(offsets, axis = 1)
+
+    def relax_chains(self, batch, active, distances):
+        origins = batch.origins[active]
+        destinations = batch.destinations[active]
+
+        # Prepare direction and normal direction
+        direct_distances = la.norm(destinations - origins, axis = 1)
+        directions = np.zeros((len(active), 2))
+
+        f_zero = direct_distances < 1e-12
+        directions[~f_zero] = (destinations[~f_zero] - origins[~f_zero]) / direct_distances[~f_zero, np.newaxis]
+
+        angles = self.random.random_sample(np.count_nonzero(f_zero)) * np.pi * 2.0
+        directions[f_zero] = np.vstack([np.cos(angles), np.sin(angles)]).T
+
+        normals = np.vstack([directions[:, 1], -directions[:, 0]]).T
+
+        if batch.size == 1:
+            return self.relax_two_points(origins, distances, directions, normals, direct_distances)
+
+        # Prepare initial locations
+        total_distances = np.sum(distances, axis = 1)
+        f_short = total_distances < 1e-12
+
+        shares = np.zeros((len(active), batch.size))
+        shares[f_short] = np.linspace(0, 1, batch.size)
+        shares[~f_short] = np.cumsum(distances[~f_short, :-1], axis = 1) / total_distances[~f_short, np.newaxis]
+
+        locations = np.zeros((len(active), batch.size + 2, 2))
+        locations[:, 0] = origins
+        locations[:, -1] = destinations
+        locations[:, 1:-1] = origins[:, np.newaxis, :] + directions[:, np.newaxis, :] * shares[:, :, np.newaxis] * direct_distances[:, np.newaxis, np.newaxis]
+
+        valid = np.zeros(len(active), dtype = bool)
+        pending = np.where(rda.calculate_feasibility_many(distances, direct_distances) == 0.0)[0]
+
+        # Add lateral deviations
+        deviation = 2.0 * (self.random.normal(size = (len(pending), batch.size)) - 0.5) * self.lateral_deviation
+        locations[pending, 1:-1] += normals[pending, np.newaxis, :] * deviation[:, :, np.newaxis]
+
+        # Prepare gravity simulation
+        origin_weights = np.ones((batch.size, 2))
+        origin_weights[0,:] = 2.0
+
+        destination_weights = np.ones((batch.size, 2))
+        destination_weights[-1,:] = 2.0
+
+        # Run gravity simulation
+        for k in range(self.maximum_relaxation_iterations):
+            if len(pending) == 0:
+                break
+
+            pending_locations = locations[pending]
+
+            chain_directions = pending_locations[:, :-1] - pending_locations[:, 1:]
+            lengths = la.norm(chain_directions, axis = 2)
+
+            offsets = distances[pending] - lengths
+            lengths[lengths < 1.0] = 1.0
+            chain_directions /= lengths[:, :, np.newaxis]
+
+            # Check which chains have converged
+            f_converged = np.all(np.abs(offsets) < self.eps, axis = 1)
+            valid[pending[f_converged]] = True
+
+            pending = pending[~f_converged]
+            offsets = offsets[~f_converged]
+            chain_directions = chain_directions[~f_converged]
+
+            # Apply adjustment to locations
+            adjustment = -0.5 * self.alpha * offsets[:, :-1, np.newaxis] * chain_directions[:, :-1] * origin_weights
+            adjustment += 0.5 * self.alpha * offsets[:, 1:, np.newaxis] * chain_directions[:, 1:] * destination_weights
+
+            locations[pending, 1:-1] += adjustment
+
+            if not np.isfinite(locations[pending]).all():
+                raise RuntimeError("NaN/Inf value encountered during gravity simulation")
+
+        return locations[:, 1:-1], valid
+
+    def relax_two_points(self, origins, distances, directions, normals, direct_distances):
+        total_distances = np.sum(distances, axis = 1)
+
+        ratios = np.ones(len(origins))
+        f_positive = (distances[:, 0] > 0.0) | (distances[:, 1] > 0.0)
+        ratios[f_positive] = distances[f_positive, 0] / total_distances[f_positive]
+
+        # Default: circle intersection
+        A = np.zeros(len(origins))
+        f_nonzero = direct_distances > 0.0
+        A[f_nonzero] = 0.5 * (distances[f_nonzero, 0]**2 - distances[f_nonzero, 1]**2 + direct_distances[f_nonzero]**2) / direct_distances[f_nonzero]
+
+        H = np.sqrt(np.maximum(0.0, distances[:, 0]**2 - A**2))
+        signs = np.where(self.random.random_sample(len(origins)) < 0.5, 1.0, -1.0)
+
+        offsets = directions * A[:, np.newaxis] + normals * (signs * H)[:, np.newaxis]
+        valid = np.ones(len(origins), dtype = bool)
+
+        # Points are too far away from each other
+        f = direct_distances < np.abs(distances[:, 0] - distances[:, 1])
+        offsets[f] = directions[f] * (ratios[f] * np.max(distances[f], axis = 1))[:, np.newaxis]
+        valid[f] = False
+
+        # Points are too close to each other
+        f = direct_distances > total_distances
+        offsets[f] = directions[f] * (ratios[f] * direct_distances[f])[:, np.newaxis]
+        valid[f] = False
+
+        # Same origin and destination
+        f = direct_distances == 0.0
+        offsets[f] = directions[f] * distances[f, 0][:, np.newaxis]
+        valid[f] = distances[f, 0] == distances[f, 1]
+
+        return (origins + offsets)[:, np.newaxis, :], valid
+
+    def discretize(self, batch, active, locations):
+        purposes = batch.purposes[active]
+
+        identifiers = np.empty(purposes.shape, dtype = object)
+        discretized_locations = np.zeros(locations.shape)
+
+        for purpose in np.unique(purposes):
+            f = purposes == purpose
+            identifiers[f], discretized_locations[f] = self.index.query_many(purpose, locations[f])
+
+        return identifiers, discretized_locations
+
+    def evaluate(self, batch, active, distances, discretized_locations):
+        locations = [discretized_locations]
+
+        if not batch.origins is None:
+            locations.insert(0, batch.origins[active, np.newaxis, :])
+
+        if not batch.destinations is None:
+            locations.append(batch.destinations[active, np.newaxis, :])
+
+        locations = np.concatenate(locations, axis = 1)
+
+        discretized_distances = la.norm(locations[:, :-1] - locations[:, 1:], axis = 2)
+        discretization_errors = np.abs(distances - discretized_distances)
+
+        excess_errors = np.maximum(0.0, discretization_errors - self.thresholds[batch.modes[active]])
+        return np.max(excess_errors, axis = 1)
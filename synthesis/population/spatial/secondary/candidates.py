@@ -0,0 +1,36 @@
+import numpy as np
+
+from synthesis.population.spatial.secondary.components import build_tree_state
+
+"""
+Prepares the candidate destinations for the assignment of secondary locations:
+identifiers, coordinates and a spatial index per purpose. The stage is cached
+like any other stage, so the spatial indices are only constructed once for a
+given set of secondary locations and then reused, e.g., when running the
+pipeline with multiple random seeds.
+"""
+
+def configure(context):
+    context.stage("synthesis.locations.secondary")
+    context.config("secloc_spatial_index", "sklearn")
+
+def execute(context):
+    df_locations = context.stage("synthesis.locations.secondary")
+    backend = context.config("secloc_spatial_index")
+
+    identifiers = df_locations["location_id"].values
+    locations = np.vstack([df_locations["geometry"].x.values, df_locations["geometry"].y.values]).T
+
+    data = {}
+
+    for purpose in ("shop", "leisure", "other"):
+        f = df_locations["offers_%s" % purpose].values
+        print("Constructing spatial index for %s ..." % purpose)
+
+        data[purpose] = dict(
+            identifiers = identifiers[f],
+            locations = locations[f],
+            tree = build_tree_state(locations[f], backend)
+        )
+
+    return data
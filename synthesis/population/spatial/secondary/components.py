@@ -1,68 +1,179 @@
 import synthesis.population.spatial.secondary.rda as rda
 import sklearn.neighbors
+import scipy.spatial
 import numpy as np
+import numpy.linalg as la
+import data.sampling as sampling
 
 class CustomDistanceSampler(rda.FeasibleDistanceSampler):
-    def __init__(self, random, distributions, maximum_iterations = 1000):
+    """
+    Samples distances from the flat tables of distance_distributions.build_sampling_tables.
+    For chains, candidate distances are drawn and evaluated in blocks. If a
+    feasible candidate is found within a block, the random state is rewound
+    such that exactly as many random numbers are consumed as when drawing
+    one candidate after another.
+    """
+    def __init__(self, random, tables, maximum_iterations = 1000, block_growth = 4):
         rda.FeasibleDistanceSampler.__init__(self, random = random, maximum_iterations = maximum_iterations)
 
         self.random = random
-        self.distributions = distributions
+        self.tables = tables
+        self.block_growth = block_growth
+        self.mode_indices = { mode: index for index, mode in enumerate(tables["modes"]) }
+
+    def find_segments(self, problem):
+        modes = np.array([self.mode_indices[mode] for mode in problem["modes"]], dtype = np.int64)
+        travel_times = np.array(problem["travel_times"], dtype = float)
+
+        bands = sampling.sample_segmented(travel_times, self.tables["bounds"], self.tables["bound_offsets"], modes)
+        return self.tables["mode_segments"][modes] + bands - self.tables["bound_offsets"][modes]
+
+    def sample_candidates(self, segments, count):
+        uniform = self.random.random_sample(count * len(segments))
+        indices = sampling.sample_segmented(uniform, self.tables["cdf"], self.tables["offsets"], np.tile(segments, count))
+        return self.tables["values"][indices].reshape(count, len(segments))
 
     def sample_distances(self, problem):
-        distances = np.zeros((len(problem["modes"])))
+        return self.sample_candidates(self.find_segments(problem), 1)[0]
+
+    def sample(self, problem):
+        origin, destination = problem["origin"], problem["destination"]
+
+        if origin is None or destination is None:
+            return rda.FeasibleDistanceSampler.sample(self, problem)
+
+        direct_distance = la.norm(destination - origin, axis = 1)
+
+        if direct_distance < 1e-3 and problem["size"] == 1:
+            return rda.FeasibleDistanceSampler.sample(self, problem)
+
+        # This is the general case
+        segments = self.find_segments(problem)
+
+        best_distances = None
+        best_delta = None
+        iterations = 0
+
+        block_size = 1
+        remaining = int(self.maximum_iterations)
+
+        while remaining > 0:
+            count = min(block_size, remaining)
+            state = self.random.get_state(legacy = False) if count > 1 else None
+
+            candidates = self.sample_candidates(segments, count)
+            deltas = rda.calculate_feasibility_many(candidates, np.repeat(direct_distance, count))
+
+            index = np.argmin(deltas)
 
-        for index, (mode, travel_time) in enumerate(zip(problem["modes"], problem["travel_times"])):
-            mode_distribution = self.distributions[mode]
+            if best_delta is None or deltas[index] < best_delta:
+                best_delta = deltas[index]
+                best_distances = candidates[index]
 
-            bound_index = np.count_nonzero(travel_time > mode_distribution["bounds"])
-            mode_distribution = mode_distribution["distributions"][bound_index]
+                if best_delta == 0.0:
+                    if index + 1 < count: # Only consume the random numbers up to the feasible candidate
+                        self.random.set_state(state)
+                        self.random.random_sample((index + 1) * len(segments))
 
-            distances[index] = mode_distribution["values"][
-                np.count_nonzero(self.random.random_sample() > mode_distribution["cdf"])
-            ]
+                    iterations += index
+                    break
 
-        return distances
+            iterations += count
+            remaining -= count
+            block_size *= self.block_growth
+
+        return dict(
+            valid = best_delta == 0.0,
+            distances = best_distances,
+            iterations = min(iterations, int(self.maximum_iterations) - 1)
+        )
+
+TREE_CLASSES = dict(
+    sklearn = sklearn.neighbors.KDTree,
+    scipy = scipy.spatial.cKDTree
+)
+
+def build_tree_state(locations, backend = "sklearn"):
+    """
+    Builds a spatial index and returns its state, which only consists of
+    plain values and arrays. This way, the index can be cached and shared
+    between processes through memory-mapped files.
+    """
+    if not backend in TREE_CLASSES:
+        raise RuntimeError("Unknown spatial index backend: %s" % backend)
+
+    return TREE_CLASSES[backend](locations).__getstate__()
+
+def restore_tree(state, backend = "sklearn"):
+    tree = TREE_CLASSES[backend].__new__(TREE_CLASSES[backend])
+    tree.__setstate__(tuple(state))
+    return tree
 
 class CandidateIndex:
-    def __init__(self, data):
+    def __init__(self, data, backend = "sklearn", workers = 1):
         self.data = data
         self.indices = {}
+        self.backend = backend
+        self.workers = workers
 
         for purpose, data in self.data.items():
-            print("Constructing spatial index for %s ..." % purpose)
-            self.indices[purpose] = sklearn.neighbors.KDTree(data["locations"])
+            if "tree" in data:
+                self.indices[purpose] = restore_tree(data["tree"], backend)
+
+            else:
+                print("Constructing spatial index for %s ..." % purpose)
+                self.indices[purpose] = restore_tree(build_tree_state(data["locations"], backend), backend)
+
+    def query_indices(self, purpose, locations):
+        if self.backend == "scipy":
+            return self.indices[purpose].query(locations, k = 1, workers = self.workers)[1]
+        else:
+            return self.indices[purpose].query(locations, return_distance = False)[:, 0]
 
     def query(self, purpose, location):
-        index = self.indices[purpose].query(location.reshape(1, -1), return_distance = False)[0][0]
+        index = self.query_indices(purpose, location.reshape(1, -1))[0]
         identifier = self.data[purpose]["identifiers"][index]
         location = self.data[purpose]["locations"][index]
         return identifier, location
 
+    def query_many(self, purpose, locations):
+        indices = self.query_indices(purpose, locations)
+        return self.data[purpose]["identifiers"][indices], self.data[purpose]["locations"][indices]
+
     def sample(self, purpose, random):
         index = random.randint(0, len(self.data[purpose]["locations"]))
         identifier = self.data[purpose]["identifiers"][index]
         location = self.data[purpose]["locations"][index]
         return identifier, location
 
+    def sample_many(self, purpose, random, count):
+        indices = random.randint(0, len(self.data[purpose]["locations"]), size = count)
+        return self.data[purpose]["identifiers"][indices], self.data[purpose]["locations"][indices]
+
 class CustomDiscretizationSolver(rda.DiscretizationSolver):
     def __init__(self, index):
         self.index = index
 
     def solve(self, problem, locations):
-        discretized_locations = []
-        discretized_identifiers = []
+        # Query all locations of the same purpose at once
+        purpose_indices = {}
+
+        for index, purpose in enumerate(problem["purposes"]):
+            purpose_indices.setdefault(purpose, []).append(index)
+
+        discretized_identifiers = [None] * problem["size"]
+        discretized_locations = np.zeros((problem["size"], 2))
 
-        for location, purpose in zip(locations, problem["purposes"]):
-            identifier, location = self.index.query(purpose, location.reshape(1, -1))
+        for purpose, indices in purpose_indices.items():
+            identifiers, discretized_locations[indices] = self.index.query_many(purpose, locations[indices])
 
-            discretized_identifiers.append(identifier)
-            discretized_locations.append(location)
+            for index, identifier in zip(indices, identifiers):
+                discretized_identifiers[index] = identifier
 
         assert len(discretized_locations) == problem["size"]
 
         return dict(
-            valid = True, locations = np.vstack(discretized_locations), identifiers = discretized_identifiers
+            valid = True, locations = discretized_locations, identifiers = discretized_identifiers
         )
 
 class CustomFreeChainSolver(rda.RelaxationSolver):
@@ -1,5 +1,6 @@
 import numpy as np
 import pandas as pd
+import data.sampling as sampling
 
 def configure(context):
     context.stage("data.hts.selected", alias = "hts")
@@ -78,3 +79,43 @@ def execute(context):
             distributions[mode]["distributions"].append(dict(cdf = cdf, values = values, weights = weights))
 
     return distributions
+
+def build_sampling_tables(distributions):
+    """
+    Flattens the distance distributions into contiguous arrays so that
+    distances can be sampled for many trips at once with sampling.sample_segmented.
+    The bounds of mode k are found in bounds[bound_offsets[k]:bound_offsets[k + 1]]
+    and band b of mode k is the segment mode_segments[k] + b of the cdf and values.
+    CDFs are sorted, which does not change the number of entries below a given
+    value and, hence, the sampled distance.
+    """
+    modes = sorted(distributions.keys())
+
+    bounds, bound_offsets, mode_segments = [], [0], []
+    cdfs, values, offsets = [], [], [0]
+
+    for mode in modes:
+        bounds.append(distributions[mode]["bounds"])
+        bound_offsets.append(bound_offsets[-1] + len(distributions[mode]["bounds"]))
+        mode_segments.append(len(offsets) - 1)
+
+        for distribution in distributions[mode]["distributions"]:
+            cdfs.append(np.sort(distribution["cdf"]))
+            values.append(distribution["values"])
+            offsets.append(offsets[-1] + len(distribution["cdf"]))
+
+    return dict(
+        modes = modes,
+        bounds = np.hstack(bounds).astype(float), bound_offsets = np.array(bound_offsets),
+        mode_segments = np.array(mode_segments),
+        cdf = np.hstack(cdfs), values = np.hstack(values).astype(float), offsets = np.array(offsets)
+    )
+
+def sample_from_tables(tables, modes, travel_times, uniform):
+    """
+    Samples one distance per trip given the mode indices (with respect to
+    tables["modes"]), the travel times and one uniform value per trip.
+    """
+    bands = sampling.sample_segmented(travel_times, tables["bounds"], tables["bound_offsets"], modes)
+    segments = tables["mode_segments"][modes] + bands - tables["bound_offsets"][modes]
+    return tables["values"][sampling.sample_segmented(uniform, tables["cdf"], tables["offsets"], segments)]
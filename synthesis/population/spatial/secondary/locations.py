@@ -3,8 +3,10 @@ import pandas as pd
 import multiprocessing as mp
 import shapely.geometry as geo
 import geopandas as gpd
+import data.shared as shared
+import data.streams as streams
 
-from synthesis.population.spatial.secondary.problems import find_assignment_problems
+from synthesis.population.spatial.secondary.problems import find_assignment_problems, find_problem_table
 
 def configure(context):
     context.stage("synthesis.population.trips")
@@ -14,12 +16,44 @@ def configure(context):
     context.stage("synthesis.population.spatial.primary.locations")
 
     context.stage("synthesis.population.spatial.secondary.distance_distributions")
-    context.stage("synthesis.locations.secondary")
+    context.stage("synthesis.population.spatial.secondary.candidates")
 
-    context.config("random_seed")
+    streams.configure_seed(context)
     context.config("processes")
 
     context.config("secloc_maximum_iterations", np.inf)
+    context.config("secloc_solver", "sequential")
+    context.config("secloc_relaxation", "numpy")
+    context.config("secloc_spatial_index", "sklearn")
+    context.config("secloc_batches", None)
+    shared.configure(context)
+    streams.configure(context)
+
+    if not context.config("secloc_solver") in ("sequential", "batched"):
+        raise RuntimeError("Unknown secondary location solver: %s" % context.config("secloc_solver"))
+
+    if not context.config("secloc_relaxation") in ("numpy", "numba"):
+        raise RuntimeError("Unknown secondary location relaxation: %s" % context.config("secloc_relaxation"))
+
+    if not context.config("secloc_spatial_index") in ("sklearn", "scipy"):
+        raise RuntimeError("Unknown secondary location spatial index: %s" % context.config("secloc_spatial_index"))
+
+    if streams.is_counter(context) and context.config("secloc_solver") == "batched" and context.config("secloc_batches") is None:
+        raise RuntimeError("The batched secondary location solver requires secloc_batches with counter-based random streams")
+
+STREAM_STAGE = "synthesis.population.spatial.secondary.locations"
+
+def create_random_seeds(context, count):
+    """
+    Creates the random seeds of the batches. With counter-based random streams,
+    every batch obtains a Philox stream instead, which the sequential solver
+    repositions for every person.
+    """
+    if streams.is_counter(context):
+        return [streams.create_bit_generator(streams.get_random_seed(context), STREAM_STAGE, index) for index in range(count)]
+
+    random = np.random.RandomState(streams.get_random_seed(context))
+    return random.randint(10000, size = count)
 
 def prepare_locations(context):
     # Load persons and their primary locations
@@ -38,24 +72,6 @@ def prepare_locations(context):
 
     return df_locations[["person_id", "home", "work", "education"]].sort_values(by = "person_id"), crs
 
-def prepare_destinations(context):
-    df_locations = context.stage("synthesis.locations.secondary")
-
-    identifiers = df_locations["location_id"].values
-    locations = np.vstack(df_locations["geometry"].apply(lambda x: np.array([x.x, x.y])).values)
-
-    data = {}
-
-    for purpose in ("shop", "leisure", "other"):
-        f = df_locations["offers_%s" % purpose].values
-
-        data[purpose] = dict(
-            identifiers = identifiers[f],
-            locations = locations[f]
-        )
-
-    return data
-
 def resample_cdf(cdf, factor):
     if factor >= 0.0:
         cdf = cdf * (1.0 + factor * np.arange(1, len(cdf) + 1) / len(cdf))
@@ -71,7 +87,10 @@ def resample_distributions(distributions, factors):
             distribution["cdf"] = resample_cdf(distribution["cdf"], factors[mode])
 
 from synthesis.population.spatial.secondary.rda import AssignmentSolver, DiscretizationErrorObjective, GravityChainSolver, AngularTailSolver, GeneralRelaxationSolver
+from synthesis.population.spatial.secondary.rda import NumbaGravityChainSolver, NumbaAngularTailSolver
 from synthesis.population.spatial.secondary.components import CustomDistanceSampler, CustomDiscretizationSolver, CandidateIndex, CustomFreeChainSolver
+from synthesis.population.spatial.secondary.batched import BatchedAssignmentSolver
+from synthesis.population.spatial.secondary.distance_distributions import build_sampling_tables
 
 def execute(context):
     # Load trips and primary locations
@@ -81,24 +100,53 @@ def execute(context):
 
     # Prepare data
     distance_distributions = context.stage("synthesis.population.spatial.secondary.distance_distributions")
-    destinations = prepare_destinations(context)
+    destinations = context.stage("synthesis.population.spatial.secondary.candidates")
 
     # Resampling for calibration
     resample_distributions(distance_distributions, dict(
         car = 0.0, car_passenger = 0.1, pt = 0.5, bike = 0.0, walk = -0.5
     ))
 
+    distance_tables = build_sampling_tables(distance_distributions)
+
     # Segment into subsamples
     processes = context.config("processes")
+    number_of_persons = df_trips["person_id"].nunique()
+
+    if context.config("secloc_batches") is None:
+        batches = create_static_batches(context, df_trips, df_primary, crs)
+    else:
+        batches = create_dynamic_batches(context, df_trips, df_primary, crs)
+
+    # Run algorithm in parallel
+    with context.progress(label = "Assigning secondary locations to persons", total = number_of_persons):
+        with shared.publish(context, dict(
+            distance_tables = distance_tables,
+            destinations = destinations
+        )) as data:
+            with context.parallel(processes = processes, data = data) as parallel:
+                df_locations, df_convergence = [], []
+
+                for df_locations_item, df_convergence_item in parallel.imap_unordered(process, batches):
+                    df_locations.append(df_locations_item)
+                    df_convergence.append(df_convergence_item)
+
+    df_locations = pd.concat(df_locations).sort_values(by = ["person_id", "activity_index"])
+    df_convergence = pd.concat(df_convergence)
+
+    print("Success rate:", df_convergence["valid"].mean())
+
+    return df_locations, df_convergence
+
+def create_static_batches(context, df_trips, df_primary, crs):
+    # One batch of persons per process
+    processes = context.config("processes")
 
     unique_person_ids = df_trips["person_id"].unique()
-    number_of_persons = len(unique_person_ids)
     unique_person_ids = np.array_split(unique_person_ids, processes)
 
-    random = np.random.RandomState(context.config("random_seed"))
-    random_seeds = random.randint(10000, size = processes)
+    random_seeds = create_random_seeds(context, processes)
 
-    # Create batch problems for parallelization
     batches = []
 
     for index in range(processes):
@@ -108,26 +156,74 @@ def execute(context):
             random_seeds[index], crs
         ))
 
-    # Run algorithm in parallel
-    with context.progress(label = "Assigning secondary locations to persons", total = number_of_persons):
-        with context.parallel(processes = processes, data = dict(
-            distance_distributions = distance_distributions,
-            destinations = destinations
-        )) as parallel:
-            df_locations, df_convergence = [], []
+    return batches
 
-            for df_locations_item, df_convergence_item in parallel.imap_unordered(process, batches):
-                df_locations.append(df_locations_item)
-                df_convergence.append(df_convergence_item)
+def estimate_costs(df_trips, df_primary):
+    # Relaxation of chains between two fixed activities is more costly than
+    # sampling free chains and tails, and grows with the length of the chain.
+    problems = find_problem_table(df_trips, df_primary)
 
-    df_locations = pd.concat(df_locations).sort_values(by = ["person_id", "activity_index"])
-    df_convergence = pd.concat(df_convergence)
+    problem_costs = 1.0 + problems["size"]
+    f_chain = problems["has_origin"] & problems["has_destination"]
+    problem_costs[f_chain] = problem_costs[f_chain]**2
 
-    print("Success rate:", df_convergence["valid"].mean())
+    person_ids = df_trips["person_id"].unique()
+    person_indices = np.searchsorted(person_ids, problems["person_id"])
 
-    return df_locations, df_convergence
+    return person_ids, 1.0 + np.bincount(person_indices, weights = problem_costs, minlength = len(person_ids))
+
+def create_dynamic_batches(context, df_trips, df_primary, crs):
+    """
+    Splits the persons into the configured number of batches with a similar
+    estimated cost. The batches and their seeds do not depend on the number of
+    processes, and the most costly batches are dispatched first.
+    """
+    number_of_batches = context.config("secloc_batches")
+    person_ids, costs = estimate_costs(df_trips, df_primary)
+
+    cumulative_costs = np.cumsum(costs) - costs
+    batch_indices = np.floor(cumulative_costs * number_of_batches / np.sum(costs)).astype(int)
+    batch_offsets = np.searchsorted(batch_indices, np.arange(number_of_batches + 1))
+
+    random_seeds = create_random_seeds(context, number_of_batches)
+
+    # Both data frames are sorted by person
+    trip_offsets = np.searchsorted(df_trips["person_id"].values, person_ids)
+    trip_offsets = np.hstack([trip_offsets, [len(df_trips)]])[batch_offsets]
+
+    primary_offsets = np.searchsorted(df_primary["person_id"].values, person_ids)
+    primary_offsets = np.hstack([primary_offsets, [len(df_primary)]])[batch_offsets]
+
+    batches, batch_costs = [], []
+
+    for index in range(number_of_batches):
+        if batch_offsets[index] == batch_offsets[index + 1]:
+            continue # Empty batch
+
+        batches.append((
+            df_trips.iloc[trip_offsets[index]:trip_offsets[index + 1]],
+            df_primary.iloc[primary_offsets[index]:primary_offsets[index + 1]],
+            random_seeds[index], crs
+        ))
+
+        batch_costs.append(np.sum(costs[batch_offsets[index]:batch_offsets[index + 1]]))
+
+    return [batches[index] for index in np.argsort(batch_costs, kind = "stable")[::-1]]
+
+def create_candidate_index(context, destinations):
+    # Only use multiple threads for queries if we do not already run in parallel
+    workers = -1 if context.config("processes") == 1 else 1
+    return CandidateIndex(destinations, backend = context.config("secloc_spatial_index"), workers = workers)
+
+THRESHOLDS = dict(
+    car = 200.0, car_passenger = 200.0, pt = 200.0,
+    bike = 100.0, walk = 100.0
+)
 
 def process(context, arguments):
+  if context.config("secloc_solver") == "batched":
+      return process_batched(context, arguments)
+
   df_trips, df_primary, random_seed, crs = arguments
 
   # Set up RNG
@@ -135,35 +231,31 @@ def process(context, arguments):
   maximum_iterations = context.config("secloc_maximum_iterations")
 
   # Set up discretization solver
-  destinations = context.data("destinations")
-  candidate_index = CandidateIndex(destinations)
+  destinations = shared.data(context, "destinations")
+  candidate_index = create_candidate_index(context, destinations)
   discretization_solver = CustomDiscretizationSolver(candidate_index)
 
   # Set up distance sampler
-  distance_distributions = context.data("distance_distributions")
   distance_sampler = CustomDistanceSampler(
         maximum_iterations = min(1000, maximum_iterations),
         random = random,
-        distributions = distance_distributions)
+        tables = shared.data(context, "distance_tables"))
 
   # Set up relaxation solver; currently, we do not consider tail problems.
-  chain_solver = GravityChainSolver(
+  numba_relaxation = context.config("secloc_relaxation") == "numba"
+
+  chain_solver = (NumbaGravityChainSolver if numba_relaxation else GravityChainSolver)(
     random = random, eps = 10.0, lateral_deviation = 10.0, alpha = 0.1,
     maximum_iterations = min(1000, maximum_iterations)
     )
 
-  tail_solver = AngularTailSolver(random = random)
+  tail_solver = (NumbaAngularTailSolver if numba_relaxation else AngularTailSolver)(random = random)
   free_solver = CustomFreeChainSolver(random, candidate_index)
 
   relaxation_solver = GeneralRelaxationSolver(chain_solver, tail_solver, free_solver)
 
   # Set up assignment solver
-  thresholds = dict(
-    car = 200.0, car_passenger = 200.0, pt = 200.0,
-    bike = 100.0, walk = 100.0
-  )
-
-  assignment_objective = DiscretizationErrorObjective(thresholds = thresholds)
+  assignment_objective = DiscretizationErrorObjective(thresholds = THRESHOLDS)
   assignment_solver = AssignmentSolver(
       distance_sampler = distance_sampler,
       relaxation_solver = relaxation_solver,
@@ -176,8 +268,17 @@ def process(context, arguments):
   df_convergence = []
 
   last_person_id = None
+  update_per_person = context.config("secloc_batches") is None
+
+  counter_streams = streams.is_counter(context)
+  last_stream_id = None
 
   for problem in find_assignment_problems(df_trips, df_primary):
+      if counter_streams and problem["person_id"] != last_stream_id:
+          # Every person draws from its own stream, independent of the batches
+          last_stream_id = problem["person_id"]
+          random.set_state(streams.get_state(streams.get_random_seed(context), STREAM_STAGE, last_stream_id))
+
       result = assignment_solver.solve(problem)
 
       starting_activity_index = problem["activity_index"]
@@ -191,13 +292,71 @@ def process(context, arguments):
           result["valid"], problem["size"]
       ))
 
-      if problem["person_id"] != last_person_id:
+      if update_per_person and problem["person_id"] != last_person_id:
           last_person_id = problem["person_id"]
           context.progress.update()
 
+  if not update_per_person:
+      context.progress.update(df_trips["person_id"].nunique())
+
   df_locations = pd.DataFrame.from_records(df_locations, columns = ["person_id", "activity_index", "location_id", "geometry"])
   df_locations = gpd.GeoDataFrame(df_locations, crs = crs)
   assert not df_locations["geometry"].isna().any()
 
   df_convergence = pd.DataFrame.from_records(df_convergence, columns = ["valid", "size"])
   return df_locations, df_convergence
+
+def process_batched(context, arguments):
+    df_trips, df_primary, random_seed, crs = arguments
+
+    random = np.random.RandomState(random_seed)
+    maximum_iterations = context.config("secloc_maximum_iterations")
+
+    candidate_index = create_candidate_index(context, shared.data(context, "destinations"))
+
+    # Same effective parameters as the sequential solver
+    assignment_solver = BatchedAssignmentSolver(
+        random = random, tables = shared.data(context, "distance_tables"),
+        index = candidate_index, thresholds = THRESHOLDS,
+        maximum_iterations = min(20, maximum_iterations),
+        maximum_distance_iterations = min(1000, maximum_iterations),
+        maximum_relaxation_iterations = min(1000, maximum_iterations),
+        lateral_deviation = 10.0, alpha = 0.3, eps = 1e-2
+    )
+
+    problems = find_problem_table(df_trips, df_primary)
+    person_ids = problems["person_id"]
+    activity_indices = problems["activity_index"]
+
+    df_locations = []
+    df_convergence = []
+
+    for result in assignment_solver.solve(problems):
+        count, size = result["identifiers"].shape
+
+        df_locations.append(pd.DataFrame({
+            "person_id": np.repeat(person_ids[result["indices"]], size),
+            "activity_index": (activity_indices[result["indices"], np.newaxis] + np.arange(size)).reshape(-1),
+            "location_id": result["identifiers"].reshape(-1),
+            "x": result["locations"][:, :, 0].reshape(-1),
+            "y": result["locations"][:, :, 1].reshape(-1)
+        }))
+
+        df_convergence.append(pd.DataFrame({
+            "valid": result["valid"], "size": size
+        }))
+
+    context.progress.update(df_trips["person_id"].nunique())
+
+    if len(df_locations) == 0:
+        df_locations = pd.DataFrame({ "person_id": [], "activity_index": [], "location_id": [], "x": [], "y": [] })
+        df_convergence = pd.DataFrame({ "valid": [], "size": [] })
+    else:
+        df_locations = pd.concat(df_locations)
+        df_convergence = pd.concat(df_convergence)
+
+    df_locations = gpd.GeoDataFrame(df_locations[["person_id", "activity_index", "location_id"]],
+        geometry = gpd.points_from_xy(df_locations["x"], df_locations["y"]), crs = crs)
+    assert not df_locations["geometry"].isna().any()
+
+    return df_locations, df_convergence
@@ -1,93 +1,117 @@
 import numpy as np
 import pandas as pd
+import geopandas as gpd
 
 FIELDS = ["person_id", "trip_index", "preceding_purpose", "following_purpose", "mode", "travel_time"]
 FIXED_PURPOSES = ["home", "work", "education"]
+LOCATION_FIELDS = ["person_id", "home", "work", "education"]
 
-def find_bare_assignment_problems(df):
-    problem = None
+def find_problem_table(df, df_locations):
+    """
+        Finds all assignment problems in a data frame of trips that is sorted by
+        person and trip index and returns them as a table of arrays:
+          - Per problem: person_id, trip_index (of the first trip),
+            activity_index (of the first variable activity), size, origin and
+            destination coordinates (NaN if the chain has a free end) and
+            has_origin / has_destination
+          - Per trip: modes and travel_times, where the trips of problem k are
+            found between trip_offsets[k] and trip_offsets[k + 1]
+          - Per variable activity: purposes, where the activities of problem k
+            are found between purpose_offsets[k] and purpose_offsets[k + 1]
+    """
+    person_ids = df["person_id"].values
+    preceding_purposes = df["preceding_purpose"].values
+    following_purposes = df["following_purpose"].values
 
-    for row in df[FIELDS].itertuples(index = False):
-        person_id, trip_index, preceding_purpose, following_purpose, mode, travel_time = row
+    f_fixed_preceding = np.isin(preceding_purposes, FIXED_PURPOSES)
+    f_fixed_following = np.isin(following_purposes, FIXED_PURPOSES)
 
-        if not problem is None and person_id != problem["person_id"]:
-            # We switch person, but we're still tracking a problem. This is a tail!
-            yield problem
-            problem = None
+    # A chain starts with the first trip of a person or after a fixed activity,
+    # and it ends with the last trip of a person or at a fixed activity.
+    f_first = np.ones(len(df), dtype = bool)
+    f_first[1:] = person_ids[1:] != person_ids[:-1]
 
-        if problem is None:
-            # Start a new problem
-            problem = dict(
-                person_id = person_id, trip_index = trip_index, purposes = [preceding_purpose],
-                modes = [], travel_times = []
-            )
+    f_start = f_first.copy()
+    f_start[1:] |= f_fixed_following[:-1]
 
-        problem["purposes"].append(following_purpose)
-        problem["modes"].append(mode)
-        problem["travel_times"].append(travel_time)
+    f_end = np.ones(len(df), dtype = bool)
+    f_end[:-1] = f_start[1:]
 
-        if problem["purposes"][-1] in FIXED_PURPOSES:
-            # The current chain (or initial tail) ends with a fixed activity.
-            yield problem
-            problem = None
+    starts = np.where(f_start)[0]
+    ends = np.where(f_end)[0]
+    problem_indices = np.cumsum(f_start) - 1
 
-    if not problem is None:
-        yield problem
+    has_origin = f_fixed_preceding[starts]
+    has_destination = f_fixed_following[ends]
 
-LOCATION_FIELDS = ["person_id", "home", "work", "education"]
+    # Variable activities: the preceding activity of the first trip if it is
+    # not fixed and all following activities that are not fixed
+    f_variable = np.vstack([f_start & ~f_fixed_preceding, ~f_fixed_following]).T
+    purposes = np.vstack([preceding_purposes, following_purposes]).T[f_variable]
+    purpose_problems = np.repeat(problem_indices, 2).reshape(-1, 2)[f_variable]
 
-def find_assignment_problems(df, df_locations):
-    """
-        Enriches assignment problems with:
-          - Locations of the fixed activities
-          - Size of the problem
-          - Reduces purposes to the variable ones
-    """
-    location_iterator = df_locations[LOCATION_FIELDS].itertuples(index = False)
-    current_location = None
+    sizes = np.bincount(purpose_problems, minlength = len(starts))
 
-    for problem in find_bare_assignment_problems(df):
-        origin_purpose = problem["purposes"][0]
-        destination_purpose = problem["purposes"][-1]
+    # We can skip problems if there are no variable activities
+    f_problem = sizes > 0
+    f_trip = f_problem[problem_indices]
 
-        # Reduce purposes
-        if origin_purpose in FIXED_PURPOSES and destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:-1]
+    starts, ends, sizes = starts[f_problem], ends[f_problem], sizes[f_problem]
+    has_origin, has_destination = has_origin[f_problem], has_destination[f_problem]
 
-        elif origin_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][1:]
+    # Locations of the fixed activities
+    df_locations = df_locations[LOCATION_FIELDS]
+    location_indices = pd.Index(df_locations["person_id"].values).get_indexer(person_ids[starts])
+    assert not np.any(location_indices < 0)
 
-        elif destination_purpose in FIXED_PURPOSES:
-            problem["purposes"] = problem["purposes"][:-1]
+    origin_purposes = preceding_purposes[starts]
+    destination_purposes = following_purposes[ends]
 
-        else:
-            pass # Neither chain nor tail
+    origins = np.full((len(starts), 2), np.nan)
+    destinations = np.full((len(starts), 2), np.nan)
 
-        # Define size
-        problem["size"] = len(problem["purposes"])
+    for purpose in FIXED_PURPOSES:
+        geometry = gpd.GeoSeries(df_locations[purpose].values)
+        coordinates = np.vstack([geometry.x.values, geometry.y.values]).T
 
-        if problem["size"] == 0:
-            continue # We can skip if there are no variable activities
+        f = has_origin & (origin_purposes == purpose)
+        origins[f] = coordinates[location_indices[f]]
 
-        # Advance location iterator until we arrive at the current problem's person
-        while current_location is None or current_location[0] != problem["person_id"]:
-            current_location = next(location_iterator)
+        f = has_destination & (destination_purposes == purpose)
+        destinations[f] = coordinates[location_indices[f]]
 
-        # Define origin and destination locations if they have fixed purposes
-        problem["origin"] = None
-        problem["destination"] = None
+    trip_indices = df["trip_index"].values[starts]
 
-        if origin_purpose in FIXED_PURPOSES:
-            problem["origin"] = current_location[LOCATION_FIELDS.index(origin_purpose)] # Shapely POINT
-            problem["origin"] = np.array([[problem["origin"].x, problem["origin"].y]])
+    return dict(
+        person_id = person_ids[starts], trip_index = trip_indices,
+        activity_index = trip_indices + has_origin,
+        size = sizes, has_origin = has_origin, has_destination = has_destination,
+        origin = origins, destination = destinations,
+        trip_offsets = np.hstack([[0], np.cumsum(ends - starts + 1)]),
+        modes = df["mode"].values[f_trip], travel_times = df["travel_time"].values[f_trip],
+        purpose_offsets = np.hstack([[0], np.cumsum(sizes)]), purposes = purposes
+    )
 
-        if destination_purpose in FIXED_PURPOSES:
-            problem["destination"] = current_location[LOCATION_FIELDS.index(destination_purpose)] # Shapely POINT
-            problem["destination"] = np.array([[problem["destination"].x, problem["destination"].y]])
+def iterate_problems(table):
+    """
+        Yields the problems of a problem table one by one as dictionaries.
+    """
+    trip_offsets, purpose_offsets = table["trip_offsets"], table["purpose_offsets"]
+
+    for k in range(len(table["size"])):
+        trips = slice(trip_offsets[k], trip_offsets[k + 1])
 
-        if problem["origin"] is None:
-            problem["activity_index"] = problem["trip_index"]
-        else:
-            problem["activity_index"] = problem["trip_index"] + 1
+        yield dict(
+            person_id = table["person_id"][k], trip_index = table["trip_index"][k],
+            activity_index = table["activity_index"][k], size = table["size"][k],
+            purposes = list(table["purposes"][purpose_offsets[k]:purpose_offsets[k + 1]]),
+            modes = list(table["modes"][trips]), travel_times = list(table["travel_times"][trips]),
+            origin = table["origin"][k:k + 1] if table["has_origin"][k] else None,
+            destination = table["destination"][k:k + 1] if table["has_destination"][k] else None
+        )
 
-        yield problem
+def find_assignment_problems(df, df_locations):
+    """
+        Yields the assignment problems of a data frame of trips, see find_problem_table.
+    """
+    return iterate_problems(find_problem_table(df, df_locations))
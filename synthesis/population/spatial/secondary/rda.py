@@ -1,5 +1,6 @@
 import numpy as np
 import numpy.linalg as la
+import numba
 
 def check_feasibility(distances, direct_distance, consider_total_distance = True):
     return calculate_feasibility(distances, direct_distance, consider_total_distance) == 0.0
@@ -16,6 +17,16 @@ def calculate_feasibility(distances, direct_distance, consider_total_distance =
 
     return float(max(delta, 0))
 
+def calculate_feasibility_many(distances, direct_distances):
+    # Same as calculate_feasibility for every row of distances
+    total_distances = np.sum(distances, axis = 1)
+    remaining_distances = total_distances[:, np.newaxis] - distances
+
+    delta = np.max(distances - direct_distances[:, np.newaxis] - remaining_distances, axis = 1)
+    delta = np.maximum(delta, direct_distances - total_distances)
+
+    return np.maximum(delta, 0.0)
+
 class DiscretizationSolver:
     def solve(self, problem, locations):
         raise NotImplementedError()
@@ -216,7 +227,19 @@ class GravityChainSolver:
         lateral_deviation = self.lateral_deviation if not self.lateral_deviation is None else max(direct_distance, 1.0)
         locations[1:-1] += normal * 2.0 * (self.random.normal(size = len(distances) - 1)[:, np.newaxis] - 0.5) * lateral_deviation
 
-        # Prepare gravity simulation
+        # Run gravity simulation
+        valid, k = self.relax(locations, distances)
+
+        return dict(
+            valid = valid, locations = locations[1:-1], iterations = k
+        )
+
+    def relax(self, locations, distances):
+        """
+        Runs the gravity simulation on the given locations (including origin
+        and destination) in place. Returns whether the chain has converged and
+        the last iteration.
+        """
         valid = False
 
         origin_weights = np.ones((len(distances) - 1, 2))
@@ -248,10 +271,149 @@ class GravityChainSolver:
             if np.isnan(locations).any() or np.isinf(locations).any():
                 raise RuntimeError("NaN/Inf value encountered during gravity simulation")
 
+        return valid, k
+
+@numba.jit(nopython = True, cache = True)
+def _accumulate_tail(anchor, directions, distances):
+    locations = np.empty((len(distances), 2))
+    x, y = anchor[0], anchor[1]
+
+    for k in range(len(distances)):
+        x += directions[k, 0] * distances[k]
+        y += directions[k, 1] * distances[k]
+        locations[k, 0] = x
+        locations[k, 1] = y
+
+    return locations
+
+def sample_tail_numba(random, anchor, distances):
+    # Same random numbers and results as sample_tail, trigonometry stays in numpy
+    angles = random.random_sample(len(distances)) * 2.0 * np.pi
+    directions = np.vstack([np.cos(angles), np.sin(angles)]).T
+    return _accumulate_tail(anchor.reshape(-1), directions, distances)
+
+class NumbaAngularTailSolver(AngularTailSolver):
+    def solve(self, problem, distances):
+        if problem["origin"] is None:
+            locations = sample_tail_numba(self.random, problem["destination"], distances)
+
+        elif problem["destination"] is None:
+            locations = sample_tail_numba(self.random, problem["origin"], distances)[::-1,:]
+
+        else:
+            raise RuntimeError("Invalid chain for AngularTailSolver")
+
+        return dict(valid = True, locations = locations)
+
+@numba.jit(nopython = True, cache = True)
+def _intersect_circles(origin, direction, distances, direct_distance):
+    """
+    Returns the case of the two point problem (0: same origin and destination,
+    1: too far apart, 2: too close, 3: intersection) and the candidate
+    locations. Only in the last case, the second location is different.
+    """
+    ratio = 1.0
+
+    if distances[0] > 0.0 or distances[1] > 0.0:
+        ratio = distances[0] / (distances[0] + distances[1])
+
+    if direct_distance == 0.0:
+        location = origin + direction * distances[0]
+        return 0, location, location
+
+    elif direct_distance > distances[0] + distances[1]:
+        location = origin + direction * ratio * direct_distance
+        return 1, location, location
+
+    elif direct_distance < np.abs(distances[0] - distances[1]):
+        location = origin + direction * ratio * max(distances[0], distances[1])
+        return 2, location, location
+
+    else:
+        A = 0.5 * ( distances[0]**2 - distances[1]**2 + direct_distance**2 ) / direct_distance
+        H = np.sqrt(max(0.0, distances[0]**2 - A**2))
+
+        center = origin + direction * A
+        offset = direction * H
+        offset = np.array([offset[1], -offset[0]])
+
+        return 3, center + 1.0 * offset, center + -1.0 * offset
+
+@numba.jit(nopython = True, cache = True)
+def _relax_gravity(locations, distances, alpha, eps, maximum_iterations):
+    """
+    Runs the gravity simulation of GravityChainSolver in place. Returns whether
+    the chain has converged, the last iteration and whether a NaN/Inf value has
+    been encountered. The arithmetic follows the numpy implementation step by
+    step so that the results are identical.
+    """
+    count = len(distances)
+    directions = np.empty((count, 2))
+    offsets = np.empty(count)
+
+    k = 0
+    for k in range(maximum_iterations):
+        converged = True
+
+        for i in range(count):
+            dx = locations[i, 0] - locations[i + 1, 0]
+            dy = locations[i, 1] - locations[i + 1, 1]
+            length = np.sqrt(dx * dx + dy * dy)
+
+            offsets[i] = distances[i] - length
+            if length < 1.0: length = 1.0
+
+            directions[i, 0] = dx / length
+            directions[i, 1] = dy / length
+
+            if not np.abs(offsets[i]) < eps:
+                converged = False
+
+        if converged:
+            return True, k, False
+
+        factor = 0.5 * alpha
+
+        for i in range(count - 1):
+            origin_weight = 2.0 if i == 0 else 1.0
+            destination_weight = 2.0 if i == count - 2 else 1.0
+
+            for j in range(2):
+                adjustment = 0.0 - factor * offsets[i] * directions[i, j] * origin_weight
+                adjustment += factor * offsets[i + 1] * directions[i + 1, j] * destination_weight
+                locations[i + 1, j] += adjustment
+
+        for i in range(1, count):
+            if not np.isfinite(locations[i, 0]) or not np.isfinite(locations[i, 1]):
+                return False, k, True
+
+    return False, k, False
+
+class NumbaGravityChainSolver(GravityChainSolver):
+    """
+    GravityChainSolver with compiled kernels for the two point case and the
+    gravity simulation. Random numbers are drawn in the same order, so the
+    results are identical to the numpy implementation.
+    """
+    def solve_two_points(self, problem, origin, destination, distances, direction, direct_distance):
+        case, location, alternative = _intersect_circles(origin.reshape(-1), direction.reshape(-1), distances, direct_distance)
+
+        if case == 3 and not self.random.random_sample() < 0.5:
+            location = alternative
+
         return dict(
-            valid = valid, locations = locations[1:-1], iterations = k
+            valid = case == 3 or (case == 0 and distances[0] == distances[1]),
+            locations = location.reshape(-1, 2), iterations = None
         )
 
+    def relax(self, locations, distances):
+        valid, k, invalid = _relax_gravity(locations, distances, self.alpha, self.eps, int(self.maximum_iterations))
+
+        if invalid:
+            raise RuntimeError("NaN/Inf value encountered during gravity simulation")
+
+        return valid, k
+
 class FeasibleDistanceSampler(DistanceSampler):
     def __init__(self, random, maximum_iterations = 1000):
         self.maximum_iterations = maximum_iterations
@@ -2,6 +2,7 @@ from tqdm import tqdm
 import itertools
 import numpy as np
 import pandas as pd
+import data.streams as streams
 
 """
 This stage duplicates trips and attaches them to the synthetic population.
@@ -9,7 +10,7 @@ This stage duplicates trips and attaches them to the synthetic population.
 
 def configure(context):
     context.stage("synthesis.population.matched")
-    context.config("random_seed")
+    streams.configure_seed(context)
 
     hts = context.config("hts")
     context.stage("data.hts.selected", alias = "hts")
@@ -30,7 +31,7 @@ def execute(context):
     df_trips = df_trips.sort_values(by = ["person_id", "trip_index"])
 
     # Diversify departure times
-    random = np.random.RandomState(context.config("random_seed"))
+    random = np.random.RandomState(streams.get_random_seed(context))
     counts = df_trips[["person_id"]].groupby("person_id").size().reset_index(name = "count")["count"].values
 
     interval = df_trips[["person_id", "departure_time"]].groupby("person_id").min().reset_index()["departure_time"].values
@@ -2,9 +2,18 @@ import re
 import pandas as pd
 import numpy as np
 from datetime import date
+import data.sampling as sampling
+import data.streams as streams
 
 """
 Creates the synthetic vehicle fleet
+
+For every vehicle, the Crit'air class and the technology are sampled from the
+fleet of the owner's municipality (or the regional fleet if the municipality
+is not known), and then the age is sampled given the Crit'air class and the
+technology. All vehicles are sampled at once: the fleet distributions of all
+municipalities and the age distributions of all combinations of Crit'air class
+and technology are stored one after another and sampled in bulk.
 """
 
 def configure(context):
@@ -14,44 +23,7 @@ def configure(context):
     context.stage("data.vehicles.types")
 
     context.config("vehicles_year", 2021)
-
-def _sample_vehicle(context, args):
-    vehicle = args
-    year = context.config("vehicles_year")
-    df_vehicle_fleet_counts, df_vehicle_age_counts = context.data("fleet"), context.data("age")
-
-    commune_id = vehicle["commune_id"]
-
-    if  commune_id in df_vehicle_fleet_counts["commune_id"].unique():
-        fleet = df_vehicle_fleet_counts.loc[df_vehicle_fleet_counts["commune_id"] == commune_id]
-        choice = fleet.sample(weights="fleet")
-        critair = choice["critair"].values[0]
-        technology = choice["technology"].values[0]
-
-        age_mask = (df_vehicle_age_counts["critair"] == critair) & (df_vehicle_age_counts["technology"] == technology)
-        age = df_vehicle_age_counts.loc[age_mask].sample(weights="fleet")["age"].values[0]
-    else:
-        choice = df_vehicle_age_counts.sample(weights="fleet")
-        critair = choice["critair"].values[0]
-        technology = choice["technology"].values[0]
-        age = choice["age"].values[0]
-
-    vehicle["critair"] = critair
-    vehicle["technology"] = technology
-    vehicle["age"] = age
-
-    euro = _get_euro_from_critair(vehicle, year)
-    vehicle["euro"] = euro
-
-    if technology == "Gazole":
-        hbefa_tech = "diesel"
-        vehicle["type_id"] = "car_%s_%s" % (hbefa_tech, euro)
-    if technology == "Essence":
-        hbefa_tech = "petrol"
-        vehicle["type_id"] = "car_%s_%s" % (hbefa_tech, euro)
-
-    context.progress.update()
-    return vehicle
+    streams.configure_seed(context)
 
 def _get_euro_from_critair(vehicle, year):
 
@@ -62,7 +34,7 @@ def _get_euro_from_critair(vehicle, year):
     # we are using the following table : https://www.ecologie.gouv.fr/sites/default/files/Tableau_classification_des_vehicules.pdf
     age_num = re.findall(r'\d+', age)
     if len(age_num) == 0:
-        raise RuntimeError("Badly formatted 'age' variable found for vehicle (id: %s) : %s" % (age, vehicle["vehicle_id"]))
+        raise RuntimeError("Badly formatted 'age' variable found for vehicles: %s" % age)
 
     birthday = int(year) - int(age_num[0])
 
@@ -111,7 +83,25 @@ def _get_euro_from_critair(vehicle, year):
 
     return euro
 
+def _create_segments(df, columns):
+    """
+    Orders the rows by the given columns and returns the ordered rows, a
+    frame with one row per segment and the offsets of the segments.
+    """
+    df = df.sort_values(columns, kind = "stable").reset_index(drop = True)
+
+    df_segments = df[columns].astype(str).drop_duplicates()
+    offsets = np.hstack([df_segments.index.values, [len(df)]])
+
+    return df, df_segments.reset_index(drop = True), offsets
+
+def _find_segments(df_segments, df, columns):
+    return pd.MultiIndex.from_frame(df_segments[columns]).get_indexer(
+        pd.MultiIndex.from_frame(df[columns].astype(str)))
+
 def execute(context):
+    random = np.random.RandomState(streams.get_random_seed(context))
+    year = context.config("vehicles_year")
 
     df_vehicle_types = context.stage("data.vehicles.types")
 
@@ -122,19 +112,65 @@ def execute(context):
 
     df_vehicles = df_vehicles.rename(columns = { "person_id": "owner_id" })
     df_vehicles["vehicle_id"] = df_vehicles["owner_id"].astype(str) + ":car"
-    df_vehicles = df_vehicles.drop_duplicates("vehicle_id") # is this needed?
+    df_vehicles = df_vehicles.drop_duplicates("vehicle_id").reset_index(drop = True) # is this needed?
     df_vehicles["type_id"] = "default_car"
     df_vehicles["mode"] = "car"
 
     df_vehicle_fleet_counts, df_vehicle_age_counts = context.stage("data.vehicles.raw")
 
-    res = []
+    # Prepare distributions per municipality and per Crit'air class and technology
+    df_fleet, df_communes, fleet_offsets = _create_segments(df_vehicle_fleet_counts, ["commune_id"])
+    fleet_cdf = sampling.build_segmented_cdf(df_fleet["fleet"].values.astype(float), fleet_offsets)
+
+    df_age, df_classes, age_offsets = _create_segments(df_vehicle_age_counts, ["critair", "technology"])
+    age_cdf = sampling.build_segmented_cdf(df_age["fleet"].values.astype(float), age_offsets)
+
+    critair = np.empty(len(df_vehicles), dtype = object)
+    technology = np.empty(len(df_vehicles), dtype = object)
+    age = np.empty(len(df_vehicles), dtype = object)
+
+    # Sample Crit'air class and technology from the municipality's fleet
+    commune_segments = _find_segments(df_communes, df_vehicles, ["commune_id"])
+    f_known = commune_segments >= 0
+
+    indices = sampling.sample_segmented(
+        random.random_sample(np.count_nonzero(f_known)), fleet_cdf, fleet_offsets, commune_segments[f_known])
+
+    critair[f_known] = df_fleet["critair"].values[indices]
+    technology[f_known] = df_fleet["technology"].values[indices]
+
+    class_segments = _find_segments(df_classes, pd.DataFrame({
+        "critair": critair[f_known], "technology": technology[f_known]
+    }), ["critair", "technology"])
+
+    if np.any(class_segments < 0):
+        raise RuntimeError("No age information available for some Crit'air classes and technologies")
+
+    indices = sampling.sample_segmented(
+        random.random_sample(np.count_nonzero(f_known)), age_cdf, age_offsets, class_segments)
+
+    age[f_known] = df_age["age"].values[indices]
+
+    # Sample all attributes from the regional fleet for other municipalities
+    indices = sampling.sample_indices(
+        random.random_sample(np.count_nonzero(~f_known)), sampling.build_cdf(df_age["fleet"].values.astype(float)))
+
+    critair[~f_known] = df_age["critair"].values[indices]
+    technology[~f_known] = df_age["technology"].values[indices]
+    age[~f_known] = df_age["age"].values[indices]
+
+    df_vehicles["critair"] = critair
+    df_vehicles["technology"] = technology
+    df_vehicles["age"] = age
+
+    # Look up the Euro class once for every combination of attributes
+    df_euro = df_vehicles[["critair", "technology", "age"]].drop_duplicates()
+    df_euro["euro"] = [_get_euro_from_critair(vehicle, year) for vehicle in df_euro.to_dict(orient = "records")]
 
-    with context.progress(label = "Processing vehicles data ...", total = len(df_vehicles)) as progress:
-        with context.parallel(dict(fleet = df_vehicle_fleet_counts, age = df_vehicle_age_counts)) as parallel:
-            for df_partial in parallel.imap(_sample_vehicle, df_vehicles.to_dict(orient="records")):
-                res.append(df_partial)
+    df_vehicles = pd.merge(df_vehicles, df_euro, on = ["critair", "technology", "age"], how = "left")
 
-    df_vehicles = pd.DataFrame.from_dict(res)
+    for technology, hbefa_tech in (("Gazole", "diesel"), ("Essence", "petrol")):
+        f = df_vehicles["technology"] == technology
+        df_vehicles.loc[f, "type_id"] = "car_%s_" % hbefa_tech + df_vehicles.loc[f, "euro"].astype(str)
 
-    return df_vehicle_types, df_vehicles
\ No newline at end of file
+    return df_vehicle_types, df_vehicles
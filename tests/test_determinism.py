@@ -100,6 +100,48 @@ def _test_determinism(index, data_path, tmpdir):
     for file in REFERENCE_GPKG_HASHES.keys():
         assert REFERENCE_GPKG_HASHES[file] == generated_gpkg_hashes[file]
 
+def test_determinism_with_counter_streams(tmpdir):
+    data_path = str(tmpdir.mkdir("data"))
+    testdata.create(data_path)
+
+    generated_hashes = [
+        _test_determinism_with_counter_streams(processes, data_path, tmpdir)
+        for processes in (1, 2)
+    ]
+
+    assert generated_hashes[0] == generated_hashes[1]
+
+def _test_determinism_with_counter_streams(processes, data_path, tmpdir):
+    print("Running with %d processes" % processes)
+
+    cache_path = str(tmpdir.mkdir("cache_%d" % processes))
+    output_path = str(tmpdir.mkdir("output_%d" % processes))
+    config = dict(
+        data_path = data_path, output_path = output_path,
+        regions = [10, 11], sampling_rate = 1.0, hts = "entd",
+        random_seed = 1000, processes = processes,
+        random_streams = "counter",
+        secloc_maximum_iterations = 10,
+        maven_skip_tests = True
+    )
+
+    stages = [
+        dict(descriptor = "synthesis.output"),
+    ]
+
+    synpp.run(stages, config, working_directory = cache_path)
+
+    generated_hashes = {
+        file: hash_file("%s/%s" % (output_path, file)) for file in [
+            "ile_de_france_activities.csv", "ile_de_france_households.csv",
+            "ile_de_france_persons.csv", "ile_de_france_trips.csv",
+            "ile_de_france_vehicles.csv"
+        ]
+    }
+
+    print("Generated CSV hashes: ", generated_hashes)
+    return generated_hashes
+
 def test_determinism_matsim(tmpdir):
     data_path = str(tmpdir.mkdir("data"))
     testdata.create(data_path)
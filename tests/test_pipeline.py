@@ -3,6 +3,8 @@ import os
 import hashlib
 from . import testdata
 import pandas as pd
+import pytest
+from .test_determinism import hash_file, hash_sqlite_db
 
 def test_data(tmpdir):
     data_path = str(tmpdir.mkdir("data"))
@@ -35,12 +37,16 @@ def test_data(tmpdir):
     assert os.path.isfile("%s/ile_de_france_hts_trips.csv" % output_path)
     assert os.path.isfile("%s/ile_de_france_sirene.gpkg" % output_path)
 
-def run_population(tmpdir, hts, update = {}):
-    data_path = str(tmpdir.mkdir("data"))
-    testdata.create(data_path)
+def run_population(tmpdir, hts, update = {}, stage = "synthesis.output", run = None):
+    data_path = str(tmpdir.join("data"))
 
-    cache_path = str(tmpdir.mkdir("cache"))
-    output_path = str(tmpdir.mkdir("output"))
+    if not os.path.exists(data_path): # Data is reused when running twice
+        os.mkdir(data_path)
+        testdata.create(data_path)
+
+    suffix = "" if run is None else "_%s" % run
+    cache_path = str(tmpdir.ensure("cache" + suffix, dir = True))
+    output_path = str(tmpdir.ensure("output" + suffix, dir = True))
     config = dict(
         data_path = data_path, output_path = output_path,
         regions = [10, 11], sampling_rate = 1.0, hts = hts,
@@ -51,7 +57,7 @@ def run_population(tmpdir, hts, update = {}):
     config.update(update)
 
     stages = [
-        dict(descriptor = "synthesis.output"),
+        dict(descriptor = stage),
     ]
 
     synpp.run(stages, config, working_directory = cache_path)
@@ -73,6 +79,15 @@ def run_population(tmpdir, hts, update = {}):
     else:
         assert 2 == len(pd.read_csv("%s/ile_de_france_vehicle_types.csv" % output_path, usecols = ["type_id"], sep = ";"))
 
+    return output_path
+
+def hash_output(output_path):
+    # Meta information contains the configuration, so it is not compared
+    return {
+        name: hash_sqlite_db("%s/%s" % (output_path, name)) if name.endswith(".gpkg") else hash_file("%s/%s" % (output_path, name))
+        for name in sorted(os.listdir(output_path)) if not name.endswith("meta.json")
+    }
+
 def test_population_with_entd(tmpdir):
     run_population(tmpdir, "entd")
 
@@ -110,3 +125,72 @@ def test_population_with_urban_type_and_egt(tmpdir):
         ],
         "matching_minimum_observations": 5
     })
+
+@pytest.mark.parametrize("update", [
+    { "matching_mode": "profiles" },
+    { "secloc_solver": "batched" },
+    { "secloc_spatial_index": "scipy", "secloc_solver": "batched" },
+    { "secloc_batches": 10, "processes": 2 },
+    { "primary_location_ordering": "knn" },
+    { "home_zones_sampling": "segmented" },
+    { "home_address_matching": "dwithin", "home_address_tile_size": 2000.0, "processes": 2 },
+    { "bdtopo_reader": "pyogrio", "processes": 2 },
+    { "income_uniform_sampling": "vectorized" },
+    { "household_sampling": "binomial" },
+])
+def test_population_with_options(tmpdir, update):
+    # These options lead to a different (but equally valid) outcome
+    run_population(tmpdir, "entd", update)
+
+def assert_same_population(tmpdir, hts, reference, updates):
+    reference_hashes = hash_output(run_population(tmpdir, hts, reference, run = "reference"))
+
+    for index, update in enumerate(updates):
+        configuration = dict(reference)
+        configuration.update(update)
+
+        assert hash_output(run_population(tmpdir, hts, configuration, run = index)) == reference_hashes
+
+@pytest.mark.parametrize("reference", [
+    { "processes": 2 },
+    { "processes": 2, "secloc_solver": "batched" }
+])
+def test_population_with_shared_data(tmpdir, reference):
+    assert_same_population(tmpdir, "entd", reference, [{ "shared_data": True }])
+
+def test_population_with_numba_relaxation(tmpdir):
+    assert_same_population(tmpdir, "entd", {}, [{ "secloc_relaxation": "numba" }])
+
+def test_population_with_bdtopo_cache(tmpdir):
+    # The cache is filled by the first run and read by the second one
+    cache_path = str(tmpdir.mkdir("bdtopo_cache"))
+
+    assert_same_population(tmpdir, "entd", { "processes": 2 }, [
+        { "bdtopo_cache_path": cache_path }, { "bdtopo_cache_path": cache_path }
+    ])
+
+def test_population_with_bhepop2_cache(tmpdir):
+    # The cache is filled by the first run and read by the second one
+    cache_path = str(tmpdir.mkdir("bhepop2_cache"))
+
+    assert_same_population(tmpdir, "egt", { "income_assignation_method": "bhepop2" }, [
+        { "bhepop2_cache_path": cache_path }, { "bhepop2_cache_path": cache_path }
+    ])
+
+def test_population_with_partitioned_output(tmpdir):
+    run_population(tmpdir, "entd", {
+        "output_partitions": ["1B", ["1A", "1C", "1D"]]
+    }, stage = "synthesis.partitioned_output")
+
+def test_population_with_cached_partitioned_output(tmpdir):
+    run_population(tmpdir, "entd", {
+        "output_partitions": ["1B", ["1A", "1C", "1D"]]
+    }, stage = "synthesis.partitioned_output")
+
+    # Rerun with partitions from the cache in a different order
+    for path in tmpdir.join("output").listdir():
+        path.remove()
+
+    run_population(tmpdir, "entd", {
+        "output_partitions": [["1A", "1C", "1D"], "1B"]
+    }, stage = "synthesis.partitioned_output")
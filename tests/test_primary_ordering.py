@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from synthesis.population.spatial.primary.locations import define_distance_ordering, define_knn_ordering
+
+class Progress:
+    def update(self, count = 1):
+        pass
+
+def create_problem(random, number_of_persons, number_of_sites):
+    # Candidates are drawn with replacement from a few sites, as in primary.candidates
+    sites = random.random_sample((number_of_sites, 2)) * 1e4
+    candidate_sites = random.randint(number_of_sites, size = number_of_persons)
+
+    df_candidates = gpd.GeoDataFrame(dict(
+        location_id = candidate_sites,
+        geometry = gpd.points_from_xy(sites[candidate_sites, 0], sites[candidate_sites, 1])
+    ))
+
+    homes = random.random_sample((number_of_persons, 2)) * 1e4
+
+    df_persons = pd.DataFrame(dict(
+        home_location = gpd.points_from_xy(homes[:, 0], homes[:, 1]),
+        commute_distance = random.random_sample(number_of_persons) * 5e3
+    ))
+
+    return df_persons, df_candidates
+
+def get_deviations(df_persons, df_candidates, indices):
+    candidates = df_candidates.iloc[indices]["geometry"]
+    homes = gpd.GeoSeries(df_persons["home_location"].values)
+
+    distances = np.sqrt((candidates.x.values - homes.x.values)**2 + (candidates.y.values - homes.y.values)**2)
+    return np.abs(distances - df_persons["commute_distance"].values)
+
+def test_knn_ordering_with_duplicate_sites():
+    random = np.random.RandomState(0)
+
+    for number_of_sites in (1, 3, 20, 50):
+        df_persons, df_candidates = create_problem(random, 2000, number_of_sites)
+        indices = define_knn_ordering(df_persons, df_candidates, Progress())
+
+        assert sorted(indices) == list(range(len(df_candidates)))
+
+def test_knn_ordering_with_few_sites():
+    # With less sites than neighbors, all remaining sites are evaluated for
+    # every person, so the ordering is the same as the greedy one
+    random = np.random.RandomState(1)
+    df_persons, df_candidates = create_problem(random, 500, 6)
+
+    knn_indices = define_knn_ordering(df_persons, df_candidates, Progress())
+    greedy_indices = define_distance_ordering(df_persons, df_candidates, Progress())
+
+    assert list(knn_indices) == list(greedy_indices)
+
+def test_knn_ordering_accuracy():
+    random = np.random.RandomState(2)
+    df_persons, df_candidates = create_problem(random, 2000, 40)
+
+    knn_deviations = get_deviations(df_persons, df_candidates, define_knn_ordering(df_persons, df_candidates, Progress()))
+    greedy_deviations = get_deviations(df_persons, df_candidates, define_distance_ordering(df_persons, df_candidates, Progress()))
+
+    assert np.median(knn_deviations) <= 2.0 * np.median(greedy_deviations) + 100.0
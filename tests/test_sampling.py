@@ -0,0 +1,81 @@
+import numpy as np
+import data.sampling as sampling
+
+def count_nonzero_scan(uniform, cdf):
+    # Reference implementation that has been used by the stages before
+    return np.array([np.count_nonzero(u > cdf) for u in uniform], dtype = np.int64)
+
+def test_sample_indices():
+    random = np.random.RandomState(0)
+
+    for weights in [
+        np.array([1.0, 2.0, 3.0, 4.0]),
+        np.array([0.0, 1.0, 0.0, 0.0, 2.0, 0.0]),
+        np.array([0.0, 0.0, 5.0]),
+        np.array([3.0]),
+        random.randint(0, 3, size = 100).astype(float) + np.eye(1, 100, 50).reshape(-1)
+    ]:
+        cdf = sampling.build_cdf(weights)
+        uniform = np.concatenate([[0.0, 1.0], cdf, random.random_sample(1000)])
+
+        assert np.all(sampling.sample_indices(uniform, cdf) == count_nonzero_scan(uniform, cdf))
+
+def test_sample_indices_zero_weights():
+    cdf = sampling.build_cdf(np.array([0.0, 1.0, 0.0, 1.0, 0.0]))
+    indices = sampling.sample_indices(np.random.RandomState(0).random_sample(1000), cdf)
+
+    # Elements without weight are not sampled for uniform values in (0, 1)
+    assert set(np.unique(indices)) == { 1, 3 }
+
+def test_alias_table():
+    weights = np.array([1.0, 0.0, 2.0, 3.0, 4.0, 0.5])
+    probabilities, aliases = sampling.build_alias_table(weights)
+
+    assert np.all(probabilities >= 0.0) and np.all(probabilities <= 1.0)
+
+    uniform = np.random.RandomState(0).random_sample(1000000)
+    indices = sampling.sample_alias(uniform, probabilities, aliases)
+
+    frequencies = np.bincount(indices, minlength = len(weights)) / len(uniform)
+    assert frequencies[1] == 0.0
+    assert np.allclose(frequencies, weights / np.sum(weights), atol = 2e-3)
+
+def test_alias_table_exact():
+    # The alias table represents the weights exactly
+    weights = np.array([1.0, 0.0, 2.0, 3.0, 4.0, 0.5])
+    probabilities, aliases = sampling.build_alias_table(weights)
+
+    mass = probabilities.copy()
+    np.add.at(mass, aliases, 1.0 - probabilities)
+
+    assert np.allclose(mass / len(weights), weights / np.sum(weights))
+
+def test_segmented_cdf():
+    random = np.random.RandomState(0)
+
+    segments = [
+        np.array([1.0, 2.0, 3.0]),
+        np.array([0.0, 4.0]),
+        np.array([7.0]),
+        random.random_sample(20),
+        np.array([0.0, 1.0, 0.0, 1.0])
+    ]
+
+    weights = np.concatenate(segments)
+    offsets = np.concatenate([[0], np.cumsum([len(segment) for segment in segments])])
+
+    cdf = sampling.build_segmented_cdf(weights, offsets)
+
+    for k, segment in enumerate(segments):
+        assert np.array_equal(cdf[offsets[k]:offsets[k + 1]], sampling.build_cdf(segment))
+
+    # Sampling from the segments gives the same as sampling every segment separately
+    uniform = random.random_sample(1000)
+    selected = random.randint(len(segments), size = 1000)
+
+    indices = sampling.sample_segmented(uniform, cdf, offsets, selected)
+
+    for k, segment in enumerate(segments):
+        f = selected == k
+        expected = offsets[k] + sampling.sample_indices(uniform[f], sampling.build_cdf(segment))
+        assert np.array_equal(indices[f], expected)
@@ -0,0 +1,41 @@
+import numpy as np
+import pickle
+import pytest
+import data.shared as shared
+from synthesis.population.spatial.secondary.components import CandidateIndex, build_tree_state
+from .test_shared import SharedContext
+
+def create_candidates(random, backend):
+    locations = random.random_sample((1000, 2)) * 1e4
+
+    return dict(shop = dict(
+        identifiers = np.arange(len(locations)) + 100,
+        locations = locations,
+        tree = build_tree_state(locations, backend)
+    ))
+
+def find_nearest(data, queries):
+    distances = np.sum((queries[:, np.newaxis, :] - data["shop"]["locations"][np.newaxis, :, :])**2, axis = 2)
+    return data["shop"]["identifiers"][np.argmin(distances, axis = 1)]
+
+@pytest.mark.parametrize("backend", ["sklearn", "scipy"])
+def test_cached_index(tmpdir, backend):
+    random = np.random.RandomState(0)
+    data = create_candidates(random, backend)
+    queries = random.random_sample((200, 2)) * 1e4
+    expected = find_nearest(data, queries)
+
+    # Index restored from the state that is returned by the stage
+    assert np.array_equal(CandidateIndex(data, backend).query_many("shop", queries)[0], expected)
+
+    # Index restored after the stage has been cached
+    cached = pickle.loads(pickle.dumps(data))
+    assert np.array_equal(CandidateIndex(cached, backend).query_many("shop", queries)[0], expected)
+
+    # Index restored from memory-mapped arrays in a worker
+    context = SharedContext(tmpdir)
+
+    with shared.publish(context, dict(destinations = data)) as published:
+        context.data_ = published
+        attached = shared.data(context, "destinations")
+        assert np.array_equal(CandidateIndex(attached, backend).query_many("shop", queries)[0], expected)
@@ -0,0 +1,108 @@
+import numpy as np
+import pandas as pd
+import shapely.geometry as geo
+from synthesis.population.spatial.secondary.problems import find_assignment_problems, FIELDS, FIXED_PURPOSES, LOCATION_FIELDS
+
+PURPOSES = FIXED_PURPOSES + ["shop", "leisure", "other"]
+MODES = ["car", "car_passenger", "pt", "bike", "walk"]
+
+def find_reference_problems(df, df_locations):
+    # Row-wise builder that has been used before the problem table
+    def find_bare_problems():
+        problem = None
+
+        for person_id, trip_index, preceding_purpose, following_purpose, mode, travel_time in df[FIELDS].itertuples(index = False):
+            if not problem is None and person_id != problem["person_id"]:
+                yield problem
+                problem = None
+
+            if problem is None:
+                problem = dict(
+                    person_id = person_id, trip_index = trip_index, purposes = [preceding_purpose],
+                    modes = [], travel_times = []
+                )
+
+            problem["purposes"].append(following_purpose)
+            problem["modes"].append(mode)
+            problem["travel_times"].append(travel_time)
+
+            if problem["purposes"][-1] in FIXED_PURPOSES:
+                yield problem
+                problem = None
+
+        if not problem is None:
+            yield problem
+
+    locations = { row[0]: row for row in df_locations[LOCATION_FIELDS].itertuples(index = False) }
+
+    for problem in find_bare_problems():
+        origin_purpose = problem["purposes"][0]
+        destination_purpose = problem["purposes"][-1]
+
+        start = 1 if origin_purpose in FIXED_PURPOSES else 0
+        end = -1 if destination_purpose in FIXED_PURPOSES else None
+        problem["purposes"] = problem["purposes"][start:end]
+        problem["size"] = len(problem["purposes"])
+
+        if problem["size"] == 0:
+            continue
+
+        location = locations[problem["person_id"]]
+        problem["origin"], problem["destination"] = None, None
+
+        if origin_purpose in FIXED_PURPOSES:
+            point = location[LOCATION_FIELDS.index(origin_purpose)]
+            problem["origin"] = np.array([[point.x, point.y]])
+
+        if destination_purpose in FIXED_PURPOSES:
+            point = location[LOCATION_FIELDS.index(destination_purpose)]
+            problem["destination"] = np.array([[point.x, point.y]])
+
+        problem["activity_index"] = problem["trip_index"] + (0 if problem["origin"] is None else 1)
+
+        yield problem
+
+def create_chains(random, number_of_persons):
+    df_trips, df_locations = [], []
+
+    for person_id in range(number_of_persons):
+        purposes = random.choice(PURPOSES, size = random.randint(2, 8))
+        count = len(purposes) - 1
+
+        df_trips.append(pd.DataFrame(dict(
+            person_id = person_id, trip_index = np.arange(count),
+            preceding_purpose = purposes[:-1], following_purpose = purposes[1:],
+            mode = random.choice(MODES, size = count), travel_time = random.random_sample(count) * 3600.0
+        )))
+
+        coordinates = random.random_sample(6) * 1e4
+
+        df_locations.append(dict(
+            person_id = person_id,
+            home = geo.Point(coordinates[0], coordinates[1]),
+            work = geo.Point(coordinates[2], coordinates[3]),
+            education = geo.Point(coordinates[4], coordinates[5])
+        ))
+
+    return pd.concat(df_trips, ignore_index = True), pd.DataFrame.from_records(df_locations)
+
+def test_find_assignment_problems():
+    random = np.random.RandomState(0)
+    df_trips, df_locations = create_chains(random, 500)
+
+    problems = list(find_assignment_problems(df_trips, df_locations))
+    reference = list(find_reference_problems(df_trips, df_locations))
+
+    assert len(problems) == len(reference)
+
+    for problem, expected in zip(problems, reference):
+        assert set(problem.keys()) == set(expected.keys())
+
+        for key in ("person_id", "trip_index", "activity_index", "size", "purposes", "modes", "travel_times"):
+            assert problem[key] == expected[key]
+
+        for key in ("origin", "destination"):
+            if expected[key] is None:
+                assert problem[key] is None
+            else:
+                assert np.array_equal(problem[key], expected[key])
@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely.geometry as geo
+from geopandas.testing import assert_geodataframe_equal
+import data.shared as shared
+
+class SharedContext:
+    def __init__(self, path, shared_data = True):
+        self.path_ = str(path)
+        self.shared_data = shared_data
+        self.data_ = None
+
+    def config(self, name):
+        assert name == "shared_data"
+        return self.shared_data
+
+    def path(self):
+        return self.path_
+
+    def data(self, name):
+        return self.data_[name]
+
+def create_frame():
+    df = gpd.GeoDataFrame(dict(
+        value = [1.5, 2.5, 3.5, 4.5],
+        count = np.array([1, 2, 3, 4], dtype = np.int64),
+        name = ["a", "b", "c", "d"],
+        zone = pd.Categorical(["x", "y", "x", "z"], categories = ["z", "y", "x"]),
+        home_location = gpd.points_from_xy([5.0, 6.0, 7.0, 8.0], [1.0, 2.0, 3.0, 4.0], crs = "EPSG:2154"),
+        area = gpd.GeoSeries([geo.box(0, 0, k + 1, k + 1) for k in range(4)], crs = "EPSG:2154").values,
+        geometry = gpd.points_from_xy([1.0, 2.0, 3.0, 4.0], [5.0, 6.0, 7.0, 8.0], crs = "EPSG:2154")
+    ), index = np.array([10, 20, 30, 40]), crs = "EPSG:2154")
+
+    return df
+
+def test_publish_frame(tmpdir):
+    context = SharedContext(tmpdir)
+    df = create_frame()
+
+    with shared.publish(context, dict(df = df)) as data:
+        context.data_ = data
+        df_shared = shared.data(context, "df")
+
+        # Points are only available as coordinates before creating them
+        assert not "geometry" in df_shared
+        assert not "home_location" in df_shared
+
+        df_shared = shared.points(df_shared, ["home_location", "geometry"])
+
+        assert isinstance(df_shared, gpd.GeoDataFrame)
+        assert list(df_shared.columns) == list(df.columns)
+        assert_geodataframe_equal(df_shared, df, check_index_type = False)
+
+def test_points_subset(tmpdir):
+    context = SharedContext(tmpdir)
+    df = create_frame()
+
+    with shared.publish(context, dict(df = df)) as data:
+        context.data_ = data
+        df_shared = shared.data(context, "df")
+
+        df_shared = shared.points(df_shared[df_shared["count"] > 2])
+        assert_geodataframe_equal(df_shared[["value", "geometry"]], df[df["count"] > 2][["value", "geometry"]], check_index_type = False)
+
+def test_without_sharing(tmpdir):
+    context = SharedContext(tmpdir, shared_data = False)
+    df = create_frame()
+
+    with shared.publish(context, dict(df = df)) as data:
+        context.data_ = data
+        assert shared.points(shared.data(context, "df"), ["home_location", "geometry"]) is df
@@ -0,0 +1,54 @@
+import numpy as np
+import data.streams as streams
+
+IDENTIFIERS = [0, 1, 2, 17, 123456789, 2**32, 2**63 + 5, 2**64 - 1]
+
+def test_philox_uniform():
+    multipliers = np.array(streams._MULTIPLIERS, dtype = np.uint64)
+    weyl = np.array(streams._WEYL, dtype = np.uint64)
+
+    for random_seed, stage in [(0, "a"), (1234, "synthesis.population.matched"), (2**40 + 3, "b")]:
+        key = streams.get_key(random_seed, stage)
+        uniform = streams._philox_uniform(key, np.array(IDENTIFIERS, dtype = np.uint64), multipliers, weyl)
+
+        for k, identifier in enumerate(IDENTIFIERS):
+            expected = np.random.RandomState(streams.create_bit_generator(random_seed, stage, identifier)).random_sample(10)
+            assert uniform[k] == expected[0]
+
+            # The first value is taken from the block at counter (1, 0, 0, identifier)
+            bit_generator = streams.create_bit_generator(random_seed, stage, identifier)
+            assert np.random.RandomState(bit_generator).random_sample() == uniform[k]
+            assert list(bit_generator.state["state"]["counter"]) == [1, 0, 0, identifier]
+
+def test_sample_uniform():
+    identifiers = ["75056", "7510", "93001"]
+    uniform = streams.sample_uniform(42, "stage", identifiers)
+
+    for k, identifier in enumerate(identifiers):
+        expected = np.random.RandomState(streams.create_bit_generator(42, "stage", identifier)).random_sample()
+        assert uniform[k] == expected
+
+    uniform = streams.sample_uniform(42, "stage", np.array(IDENTIFIERS, dtype = np.uint64))
+
+    for k, identifier in enumerate(IDENTIFIERS):
+        expected = np.random.RandomState(streams.create_bit_generator(42, "stage", identifier)).random_sample()
+        assert uniform[k] == expected
+
+def test_state_roundtrip():
+    random = np.random.RandomState(streams.create_bit_generator(7, "stage", 0))
+    random.normal() # Leave a cached Gaussian value in the state
+
+    for identifier in IDENTIFIERS:
+        random.set_state(streams.get_state(7, "stage", identifier))
+        reference = np.random.RandomState(streams.create_bit_generator(7, "stage", identifier))
+
+        assert np.array_equal(random.random_sample(5), reference.random_sample(5))
+        assert np.array_equal(random.normal(size = 3), reference.normal(size = 3))
+        assert np.array_equal(random.randint(100, size = 5), reference.randint(100, size = 5))
+
+        # A state obtained from a stream can be restored as well
+        state = random.get_state(legacy = False)
+        expected = random.random_sample(5)
+
+        random.set_state(state)
+        assert np.array_equal(random.random_sample(5), expected)